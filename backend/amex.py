@@ -1,13 +1,35 @@
-import tkinter as tk
-from tkinter import filedialog
+import argparse
+import os
 import pandas as pd
 import sqlite3
-from typing import Optional
+from typing import Iterable, List, Optional
 
-from app import get_db_connection
+import bulk
+import merchants
+import sync_state
+import views
+from db import get_db_connection
+
+
+# CSV headers in the order of AmexRawTransaction.to_row
+CSV_COLUMNS = [
+    "Date", "Description", "Amount", "Extended Details", "Appears On Your Statement As",
+    "Address", "Town/City", "Postcode", "Country", "Reference", "Category"
+]
+
+DATE_FORMAT = "%d/%m/%Y"
+
+# Read everything as text except the amount; Reference in particular must not lose leading zeros
+CSV_DTYPES = {name: str for name in CSV_COLUMNS} | {"Amount": float}
+
+CHUNK_SIZE = 10000
 
 
 def select_and_parse_amex_file():
+    # Imported lazily so headless imports (e.g. inside the container) never need a display
+    import tkinter as tk
+    from tkinter import filedialog
+
     root = tk.Tk()
     root.withdraw()
 
@@ -15,6 +37,33 @@ def select_and_parse_amex_file():
 
 
 class AmexRawTransaction:
+    TABLE = "amex_raw"
+    KEY = "reference"
+    KEY_INDEX = 9  # position of reference in to_row()
+    UPSERT_SQL = """
+        INSERT INTO amex_raw (
+            date, description, amount, extended_details, appears_on_statement_as,
+            address, town_city, postcode, country, reference, category, timestamp, month,
+            content_hash, ingestion_timestamp
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(reference) DO UPDATE SET
+            date = excluded.date,
+            description = excluded.description,
+            amount = excluded.amount,
+            extended_details = excluded.extended_details,
+            appears_on_statement_as = excluded.appears_on_statement_as,
+            address = excluded.address,
+            town_city = excluded.town_city,
+            postcode = excluded.postcode,
+            country = excluded.country,
+            category = excluded.category,
+            timestamp = excluded.timestamp,
+            month = excluded.month,
+            content_hash = excluded.content_hash,
+            ingestion_timestamp = CURRENT_TIMESTAMP
+        WHERE content_hash IS NOT excluded.content_hash
+    """
+
     def __init__(self,
                  date: str,
                  description: str,
@@ -58,33 +107,29 @@ class AmexRawTransaction:
             category=row.get("Category")
         )
 
+    def to_row(self) -> tuple:
+        return (
+            self.date, self.description, self.amount, self.extended_details,
+            self.appears_on_statement_as, self.address, self.town_city,
+            self.postcode, self.country, self.reference, self.category,
+            *bulk.parse_date_keys([self.date], DATE_FORMAT)[0]
+        )
+
+    @staticmethod
+    def rows_from_dataframe(df: pd.DataFrame):
+        """
+        Column-oriented equivalent of from_dataframe(...).to_row() for every row of the DataFrame.
+        """
+        columns = [df[name].tolist() if name in df else [None] * len(df) for name in CSV_COLUMNS]
+        date_keys = bulk.parse_date_keys(columns[0], DATE_FORMAT)
+        return zip(*columns, [key[0] for key in date_keys], [key[1] for key in date_keys])
+
     def insert_into_db(self, cursor: sqlite3.Cursor):
         """
         Insert the AmexTransactionRaw data into an SQLite database.
-        On conflict of reference (primary key), update all other columns.
+        On conflict of reference (primary key), update all other columns if the content changed.
         """
-        cursor.execute("""
-            INSERT INTO amex_raw (
-                date, description, amount, extended_details, appears_on_statement_as, 
-                address, town_city, postcode, country, reference, category, ingestion_timestamp
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(reference) DO UPDATE SET
-                date = excluded.date,
-                description = excluded.description,
-                amount = excluded.amount,
-                extended_details = excluded.extended_details,
-                appears_on_statement_as = excluded.appears_on_statement_as,
-                address = excluded.address,
-                town_city = excluded.town_city,
-                postcode = excluded.postcode,
-                country = excluded.country,
-                category = excluded.category,
-                ingestion_timestamp = CURRENT_TIMESTAMP
-        """, (
-            self.date, self.description, self.amount, self.extended_details,
-            self.appears_on_statement_as, self.address, self.town_city,
-            self.postcode, self.country, self.reference, self.category
-        ))
+        cursor.execute(self.UPSERT_SQL, bulk.with_hash(self.to_row()))
 
     @staticmethod
     def create_table(cursor: sqlite3.Cursor):
@@ -104,23 +149,91 @@ class AmexRawTransaction:
                 country TEXT,
                 reference TEXT PRIMARY KEY,
                 category TEXT,
+                timestamp INTEGER,  -- epoch seconds of date, parsed on load
+                month TEXT,  -- YYYY-MM of date
+                content_hash TEXT,
                 ingestion_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        bulk.ensure_column(cursor, "amex_raw", "content_hash", "TEXT")
+        if bulk.ensure_column(cursor, "amex_raw", "timestamp", "INTEGER"):
+            bulk.ensure_column(cursor, "amex_raw", "month", "TEXT")
+            # One-off backfill of rows loaded before the keys were stored
+            cursor.execute("""
+                UPDATE amex_raw SET
+                    timestamp = cast(strftime('%s', substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)) AS integer),
+                    month = substr(date, 7, 4) || '-' || substr(date, 4, 2)
+            """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_amex_raw_timestamp ON amex_raw (timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_amex_raw_month ON amex_raw (month)")
+        # Same expression as transaction_id in the cleaned view, so refresh_transactions' lookups by id are indexed
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_amex_raw_transaction_id ON amex_raw (cast(reference as varchar))")
 
 
-def main():
-    df = pd.read_csv(select_and_parse_amex_file())
-    conn = get_db_connection(True)
+def parse_dates(dates: pd.Series) -> pd.Series:
+    """
+    Normalises statement dates to zero-padded DD/MM/YYYY before their timestamp and month keys are derived.
+    Raises on anything that is not a day-first date rather than storing it.
+    """
+    return pd.to_datetime(dates, format=DATE_FORMAT).dt.strftime(DATE_FORMAT)
+
+
+def csv_paths(paths: Iterable[str]) -> List[str]:
+    """
+    Expands directories into the CSV files they contain.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(".csv")))
+        else:
+            files.append(path)
+    return files
+
+
+def load_csv(cursor: sqlite3.Cursor, path: str, batch_size: int = bulk.DEFAULT_BATCH_SIZE, chunk_size: int = CHUNK_SIZE) -> bulk.UpsertStats:
+    """
+    Streams one statement export into amex_raw, chunk_size rows at a time, so memory use does not grow with the file.
+    """
+    stats = bulk.UpsertStats()
+    for chunk in pd.read_csv(path, dtype=CSV_DTYPES, chunksize=chunk_size):
+        chunk["Date"] = parse_dates(chunk["Date"])
+        stats += bulk.bulk_upsert(cursor, AmexRawTransaction, AmexRawTransaction.rows_from_dataframe(chunk), batch_size)
+    return stats
+
+
+def store(conn, paths: Iterable[str], batch_size: int = bulk.DEFAULT_BATCH_SIZE, chunk_size: int = CHUNK_SIZE) -> bulk.UpsertStats:
+    """
+    Imports every CSV in `paths` in one transaction and commits.
+    """
     cursor = conn.cursor()
     AmexRawTransaction.create_table(cursor)
+    merchants.create_table(cursor)
 
-    for _, row in df.iterrows():
-        transaction = AmexRawTransaction.from_dataframe(row)
-        transaction.insert_into_db(cursor)
+    stats = bulk.UpsertStats()
+    for path in paths:
+        stats += load_csv(cursor, path, batch_size, chunk_size)
 
+    views.refresh_transactions(cursor, 'AMEX', stats.changed_keys)
+    merchants.refresh(cursor, 'AMEX', stats.changed_keys)
+    if stats.changed_keys:
+        sync_state.bump_data_version(cursor)
     conn.commit()
+    return stats
+
+
+def main(paths: Optional[List[str]] = None, batch_size: int = bulk.DEFAULT_BATCH_SIZE, chunk_size: int = CHUNK_SIZE):
+    paths = csv_paths(paths) if paths else [select_and_parse_amex_file()]
+    conn = get_db_connection(True)
+    with bulk.load_pragmas(conn):
+        stats = store(conn, paths, batch_size, chunk_size)
     conn.close()
+    print(f"Amex: {stats.inserted} inserted, {stats.updated} updated, {stats.unchanged} unchanged")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Import Amex statement CSV exports.")
+    parser.add_argument('paths', nargs='*', help="CSV files or directories of CSVs. Opens a file picker when omitted.")
+    parser.add_argument('--batch-size', type=int, default=bulk.DEFAULT_BATCH_SIZE)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    main(args.paths, args.batch_size, args.chunk_size)
@@ -1,13 +1,58 @@
-import sqlglot
-
-from categories import update_categories, Category, pull_transactions
-from fastapi import FastAPI, Depends
+import base64
+import json
+import logging
+import os
+
+import db
+import queries
+import rules
+import sync_state
+from categories import update_categories, categorize_many, propagate_to_merchant, reapply_rules, Category, pull_transactions, pull_transaction_page, run_model_batch, search_transactions
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import date, datetime, timedelta, timezone
+from db import get_db
+from metrics import MetricsMiddleware, registry
+from response_cache import ResponseCacheMiddleware
+from fastapi import FastAPI, Depends, BackgroundTasks, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from typing import Optional
 
 import sqlite3
-from pydantic import BaseModel
-app = FastAPI()
+from pydantic import BaseModel, Field
+
+logging.basicConfig(level=os.environ.get("BUDGET_LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+
+def data_version() -> int:
+    conn = db.pool.acquire()
+    try:
+        return sync_state.data_version(conn.cursor())
+    finally:
+        db.pool.release(conn)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    conn = db.pool.acquire()
+    try:
+        sync_state.create_table(conn.cursor())
+        conn.commit()
+    finally:
+        db.pool.release(conn)
+    yield
+    db.pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+# Middleware added later wraps what was added before it.
+# Aggregates only change when data is loaded or categorized; every such write, in this process or
+# another (the loader CLIs), bumps the data version stored in the database
+app.add_middleware(ResponseCacheMiddleware, paths=["/total", "/pivot_data", "/category_spend", "/category_spend/batch"],
+                   version=data_version)
+# Outside the cache, which builds its responses afresh, so cached responses get the CORS headers too
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000"],  # Allow requests from your React app
@@ -15,95 +60,194 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all HTTP methods (GET, POST, etc.)
     allow_headers=["*"],  # Allow all headers
 )
+# Outermost, so latency includes cache hits and every other middleware
+app.add_middleware(MetricsMiddleware)
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
 
 class TransactionUpdate(BaseModel):
     transaction_id: str
     user_category: Category
+    # Also give the rest of the merchant's transactions this category, unless the user categorized them
+    propagate_to_merchant: bool = False
 
 class MultipleTransactionUpdate(BaseModel):
     transaction_ids: list[str]
     user_category: Category
 
+class CategoryRule(BaseModel):
+    pattern: str = Field(..., pattern=r"\S")  # matched with spaces removed, so it needs something else
+    category: Category
+    priority: int = rules.DEFAULT_PRIORITY
+    account: Optional[str] = Field(None, pattern=r"(?i)^(amex|monzo|splitwise)$")
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+
 class GetTransactions(BaseModel):
-    month: Optional[str] = None
+    month: Optional[str] = Field(None, pattern=r"^\d{4}-(0[1-9]|1[0-2])$")  # YYYY-MM
     uncategorized: Optional[bool] = False
 
+class GetTransactionPage(BaseModel):
+    limit: int = Field(100, ge=1, le=1000)
+    cursor: Optional[str] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None  # inclusive
+    account: Optional[str] = None
+    category: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+    uncategorized: bool = False
+
+
+def encode_cursor(timestamp, transaction_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([int(timestamp), transaction_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        timestamp, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(timestamp), str(transaction_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def day_start(day: date) -> int:
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
 
-def get_db_connection(is_local: bool = False):
-    if is_local:
-        conn = sqlite3.connect("/Users/matthew.coudert/budget/db/transactions.db")
-    else:
-        conn = sqlite3.connect("/db/transactions.db")
-    conn.row_factory = sqlite3.Row
-    return conn
 
 @app.get("/transactions/")
-def get_transactions(get: GetTransactions = Depends()):
-    print(get)
-    conn = get_db_connection()
+def get_transactions(get: GetTransactions = Depends(), conn: sqlite3.Connection = Depends(get_db)):
+    logger.debug("get_transactions %s", get)
     cursor = conn.cursor()
     transactions = pull_transactions(cursor, get.month, get.uncategorized)
-    conn.close()
     return [{"transaction_id": t[0], "date": t[1], "description": t[2], "amount": t[3], "account": t[4], "category": t[5]} for t in transactions]
 
 
+@app.get("/transactions/page")
+def get_transaction_page(get: GetTransactionPage = Depends(), conn: sqlite3.Connection = Depends(get_db)):
+    rows = pull_transaction_page(
+        conn.cursor(),
+        get.limit,
+        after=decode_cursor(get.cursor) if get.cursor else None,
+        start=day_start(get.start_date) if get.start_date else None,
+        end=day_start(get.end_date + timedelta(days=1)) if get.end_date else None,
+        account=get.account,
+        category=get.category,
+        min_amount=get.min_amount,
+        max_amount=get.max_amount,
+        uncategorized_only=get.uncategorized,
+    )
+    page, more = rows[:get.limit], len(rows) > get.limit
+    return {
+        "transactions": [{"transaction_id": t["transaction_id"], "date": t["date"], "description": t["description"],
+                          "amount": t["amount"], "account": t["account"], "category": t["category"]} for t in page],
+        "next_cursor": encode_cursor(page[-1]["timestamp"], page[-1]["transaction_id"]) if more else None,
+    }
+
+
+@app.get("/search")
+def search(q: str, limit: int = Query(50, ge=1, le=500), conn: sqlite3.Connection = Depends(get_db)):
+    rows = search_transactions(conn.cursor(), q, limit)
+    return [{"transaction_id": t["transaction_id"], "date": t["date"], "description": t["description"],
+             "amount": t["amount"], "account": t["account"], "category": t["category"]} for t in rows]
+
+
+@app.get("/categories/")
+def list_categories(conn: sqlite3.Connection = Depends(get_db)):
+    rows = conn.execute("SELECT DISTINCT category FROM monthly_rollup ORDER BY category").fetchall()
+    return [row["category"] for row in rows]
+
+
 @app.put("/categorize/")
-def categorize_transaction(update: TransactionUpdate):
-    conn = get_db_connection()
+def categorize_transaction(update: TransactionUpdate, conn: sqlite3.Connection = Depends(get_db)):
     cursor = conn.cursor()
     update_categories(transaction_id=update.transaction_id, cursor=cursor, user_category=update.user_category.value)
+    propagated = propagate_to_merchant(cursor, update.transaction_id, update.user_category.value) if update.propagate_to_merchant else 0
+    sync_state.bump_data_version(cursor)
     conn.commit()
-    conn.close()
-    return {"message": "Transaction categorized successfully"}
+    return {"message": "Transaction categorized successfully", "propagated": propagated}
 
 
 @app.put("/categorize_multiple/")
-def categorize_multiple_transactions(update: MultipleTransactionUpdate):
-    conn = get_db_connection()
+def categorize_multiple_transactions(update: MultipleTransactionUpdate, conn: sqlite3.Connection = Depends(get_db)):
     cursor = conn.cursor()
-
-    num_categorized = 0
-
-    for txn_id in update.transaction_ids:
-        if update_categories(transaction_id=txn_id, cursor=cursor, user_category=update.user_category.value):
-            num_categorized += 1
+    applied, unknown = categorize_many(cursor, update.transaction_ids, update.user_category.value)
+    if applied:
+        sync_state.bump_data_version(cursor)
     conn.commit()
-    conn.close()
-    return {"message": f"{num_categorized} transactions categorized successfully"}
+    return {
+        "message": f"{applied} transactions categorized successfully",
+        "applied": applied,
+        "unknown": len(unknown),
+        "unknown_ids": unknown,
+    }
 
 @app.put("/auto_categorize/")
-def auto_categorize():
-    from categories import run_model
-    conn = get_db_connection()
+def auto_categorize(conn: sqlite3.Connection = Depends(get_db)):
     cursor = conn.cursor()
 
-    transactions = pull_transactions(cursor, None, True)
-    num_categorized = 0
-    for transaction in transactions:
-        transaction_id = transaction[0]
-        description = transaction[2]
-        if run_model(transaction_id, description, cursor):
-            num_categorized += 1
+    counts = run_model_batch(cursor)
+
+    sync_state.bump_data_version(cursor)
+    conn.commit()
+    return {"message": f"{sum(counts.values())} transactions auto-categorized successfully", "categories": counts}
+
+
+@app.get("/rules/")
+def list_rules(conn: sqlite3.Connection = Depends(get_db)):
+    return [asdict(rule) for rule in rules.load_rules(conn.cursor())]
 
+
+def apply_rule_change(conn: sqlite3.Connection, patterns, rule: rules.Rule) -> dict:
+    """
+    Re-evaluates the transactions the changed patterns could affect and commits the change with them.
+    """
+    cursor = conn.cursor()
+    reapplied = reapply_rules(cursor, patterns)
+    if reapplied["changed"]:
+        sync_state.bump_data_version(cursor)
     conn.commit()
-    conn.close()
-    return {"message": f"{num_categorized} transactions auto-categorized successfully"}
+    return {"rule": asdict(rule), **reapplied}
+
+
+@app.post("/rules/", status_code=201)
+def create_rule(rule: CategoryRule, conn: sqlite3.Connection = Depends(get_db)):
+    created = rules.add_rule(conn.cursor(), rule.pattern, rule.category.value, rule.priority, rule.account, rule.min_amount, rule.max_amount)
+    return apply_rule_change(conn, [created.pattern], created)
+
+
+@app.put("/rules/{rule_id}")
+def replace_rule(rule_id: int, rule: CategoryRule, conn: sqlite3.Connection = Depends(get_db)):
+    cursor = conn.cursor()
+    previous = rules.update_rule(cursor, rules.Rule(rule_id, rule.pattern, rule.category.value, rule.priority, rule.account, rule.min_amount, rule.max_amount))
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    updated = rules.get_rule(cursor, rule_id)
+    return apply_rule_change(conn, [previous.pattern, updated.pattern], updated)
+
+
+@app.delete("/rules/{rule_id}")
+def delete_rule(rule_id: int, conn: sqlite3.Connection = Depends(get_db)):
+    previous = rules.delete_rule(conn.cursor(), rule_id)
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    return apply_rule_change(conn, [previous.pattern], previous)
 
 
 @app.get("/pivot_data")
-def get_pivot_data():
-    conn = get_db_connection()
+def get_pivot_data(conn: sqlite3.Connection = Depends(get_db)):
     cursor = conn.cursor()
 
     query = """
         SELECT
-            strftime('%Y-%m', timestamp, 'unixepoch') AS month,
-            coalesce(category, 'UNKNOWN') AS category,
-            sum(coalesce(amount, 0)) AS amount
+            month,
+            category,
+            sum(amount) AS amount
         FROM
-            transactions_with_category
+            monthly_rollup
         WHERE
-            timestamp >= strftime('%s', '2022-08-01')
+            month >= '2022-08'
         GROUP BY
             month, category
         ORDER BY
@@ -111,22 +255,17 @@ def get_pivot_data():
     """
     cursor.execute(query)
     data = cursor.fetchall()
-    conn.close()
 
     # Format the data for the pivot table
     return [{"month": row[0], "category": row[1], "amount": row[2]} for row in data]
 
 
 @app.get("/total")
-def get_total(category: Optional[str] = None):
-    query = sqlglot.select("sum(amount)").from_("transactions_with_category")
-    if category:
-        query = query.where(f"category = '{category}'")
-    conn = get_db_connection()
+def get_total(category: Optional[str] = None, conn: sqlite3.Connection = Depends(get_db)):
     cursor = conn.cursor()
 
-    result = cursor.execute(query.sql("sqlite")).fetchone()
-    total = result['SUM(amount)'] if result['SUM(amount)'] is not None else 0
+    result = cursor.execute(queries.total_query(bool(category)), {"category": category}).fetchone()
+    total = result['total'] if result['total'] is not None else 0
 
     return {"total": total}
 
@@ -134,53 +273,61 @@ def get_total(category: Optional[str] = None):
 def read_root():
     return {"Hello": "World"}
 
-@app.get("/full_load")
-def full_load():
-    from full_load import main
-    main()
-    return {"message": "Data loaded successfully"}
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
-@app.get("/category_spend")
-def category_spend(category: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
+@app.get("/full_load", status_code=202)
+def full_load(background_tasks: BackgroundTasks):
+    from full_load import job
+    if job.start():
+        background_tasks.add_task(job.run)
+        return {"message": "Data load started", **job.status()}
+    return {"message": "Data load already running", **job.status()}
+
+
+@app.get("/full_load/status")
+def full_load_status():
+    from full_load import job
+    return job.status()
 
+
+def query_category_spend(cursor: sqlite3.Cursor, categories: list[str], start_year: int, end_year: Optional[int]):
+    """
+    Monthly spend for every requested category in one grouped pass over monthly_rollup, keyed by category.
+    """
+    categories = [category.upper() for category in categories]
     query = """
         SELECT
-            strftime('%Y', datetime(timestamp, 'unixepoch')) AS year,
-            strftime('%m', datetime(timestamp, 'unixepoch')) AS month_number,
-            strftime('%m', datetime(timestamp, 'unixepoch')) || '-' || strftime('%Y-%m', datetime(timestamp, 'unixepoch')) AS sort_key,
-            CASE strftime('%m', datetime(timestamp, 'unixepoch'))
-                WHEN '01' THEN 'Jan'
-                WHEN '02' THEN 'Feb'
-                WHEN '03' THEN 'Mar'
-                WHEN '04' THEN 'Apr'
-                WHEN '05' THEN 'May'
-                WHEN '06' THEN 'Jun'
-                WHEN '07' THEN 'Jul'
-                WHEN '08' THEN 'Aug'
-                WHEN '09' THEN 'Sep'
-                WHEN '10' THEN 'Oct'
-                WHEN '11' THEN 'Nov'
-                WHEN '12' THEN 'Dec'
-            END AS month,
+            category,
+            substr(month, 1, 4) AS year,
+            cast(substr(month, 6, 2) AS integer) AS month_number,
             SUM(amount) AS amount
-        FROM transactions_with_category
-        WHERE category LIKE ? AND year >= '2023'
-        GROUP BY year, month_number
-        ORDER BY year, month_number
+        FROM monthly_rollup
+        WHERE category IN (SELECT value FROM json_each(?)) AND month >= ? AND month < ?
+        GROUP BY category, month
+        ORDER BY category, month
     """
-    cursor.execute(query, (category.upper(),))
-    rows = cursor.fetchall()
-    conn.close()
+    end = str(end_year + 1) if end_year is not None else '9999'
+    cursor.execute(query, (json.dumps(categories), str(start_year), end))
 
-    return [
-        {
+    spend = {category: [] for category in categories}
+    for row in cursor.fetchall():
+        spend[row["category"]].append({
             "year": int(row["year"]),
-            "month": row["month"],
+            "month": MONTH_NAMES[row["month_number"] - 1],
             "amount": float(row["amount"])
-        }
-        for row in rows
-    ]
+        })
+    return spend
+
+
+@app.get("/category_spend")
+def category_spend(category: str, conn: sqlite3.Connection = Depends(get_db)):
+    return query_category_spend(conn.cursor(), [category], 2023, None)[category.upper()]
+
 
+@app.get("/category_spend/batch")
+def category_spend_batch(category: list[str] = Query(...), start_year: int = 2023, end_year: Optional[int] = None,
+                         conn: sqlite3.Connection = Depends(get_db)):
+    return query_category_spend(conn.cursor(), category, start_year, end_year)
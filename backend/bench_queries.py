@@ -0,0 +1,60 @@
+import argparse
+import sqlite3
+import timeit
+
+import categories
+import queries
+
+
+def sample_db(rows: int) -> sqlite3.Connection:
+    """
+    In-memory stand-in for transactions_with_category with `rows` rows spread over 2023.
+    """
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""
+        CREATE TABLE transactions_with_category (
+            transaction_id TEXT PRIMARY KEY, timestamp INTEGER, description TEXT,
+            amount REAL, account TEXT, category TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_sample_timestamp ON transactions_with_category (timestamp)")
+    conn.executemany(
+        "INSERT INTO transactions_with_category VALUES (?, ?, ?, ?, ?, ?)",
+        [(f"t{i}", 1672531200 + i * 31536000 // rows, f"MERCHANT {i % 50}", -(i % 100) / 3, "AMEX",
+          None if i % 3 else "GROCERIES") for i in range(rows)]
+    )
+    return conn
+
+
+def per_call_us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main(rows: int, number: int):
+    conn = sample_db(rows)
+    cursor = conn.cursor()
+    params = {"history_start": categories.HISTORY_START, "category": "GROCERIES"}
+    params["start"], params["end"] = categories.month_bounds("2023-06")
+
+    # __wrapped__ is the builder without its cache, i.e. what every request used to pay
+    cases = {
+        "transactions_query": lambda cached: (queries.transactions_query if cached else queries.transactions_query.__wrapped__)(True, True),
+        "total_query": lambda cached: (queries.total_query if cached else queries.total_query.__wrapped__)(True),
+        "pull_transactions (June 2023)": lambda cached: cursor.execute(
+            (queries.transactions_query if cached else queries.transactions_query.__wrapped__)(True, True), params).fetchall(),
+        "total (GROCERIES)": lambda cached: cursor.execute(
+            (queries.total_query if cached else queries.total_query.__wrapped__)(True), params).fetchall(),
+    }
+    print(f"{'case':<32}{'uncached us/call':>18}{'cached us/call':>18}{'speedup':>10}")
+    for name, case in cases.items():
+        before = per_call_us(lambda: case(False), number)
+        after = per_call_us(lambda: case(True), number)
+        print(f"{name:<32}{before:>18.1f}{after:>18.1f}{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-call cost of building request SQL with and without the shape cache.")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+    main(args.rows, args.number)
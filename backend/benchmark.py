@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from itertools import islice
+
+from fastapi.testclient import TestClient
+
+import amex
+import bulk
+import categories
+import db
+import monzo
+import splitwise
+import synthetic
+import views
+from response_cache import cache
+
+MONZO_CHUNK = 100000  # sheet records handed to monzo.store at a time, so 1M-row runs stay in memory
+DAILY_MONZO_ROWS = 10  # rows appended to the sheet between the full and the incremental sync
+
+# (label, method, path, query params) timed through the app; writes are timed separately, on a copy
+ROUTES = [
+    ("GET /transactions/", "GET", "/transactions/", {"uncategorized": True}),
+    ("GET /transactions/ month", "GET", "/transactions/", {"month": "2024-03", "uncategorized": False}),
+    ("GET /transactions/page", "GET", "/transactions/page", {"limit": 100}),
+    ("GET /transactions/page filtered", "GET", "/transactions/page",
+     {"limit": 100, "start_date": "2023-01-01", "end_date": "2023-12-31", "account": "amex", "min_amount": -50}),
+    ("GET /search", "GET", "/search", {"q": "tesco"}),
+    ("GET /categories/", "GET", "/categories/", None),
+    ("GET /pivot_data", "GET", "/pivot_data", None),
+    ("GET /total", "GET", "/total", None),
+    ("GET /total category", "GET", "/total", {"category": "GROCERIES"}),
+    ("GET /category_spend", "GET", "/category_spend", {"category": "GROCERIES"}),
+    ("GET /category_spend/batch", "GET", "/category_spend/batch",
+     [("category", c) for c in ("BILLS", "GROCERIES", "TRANSPORT", "SHOPPING", "EATING_OUT")]),
+    ("GET /rules/", "GET", "/rules/", None),
+    ("GET /metrics", "GET", "/metrics", None),
+]
+CATEGORIZE_MULTIPLE_IDS = 50  # transactions per /categorize_multiple/ call
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def summary(seconds) -> dict:
+    ms = [s * 1000 for s in seconds]
+    return {"min_ms": round(min(ms), 3), "median_ms": round(statistics.median(ms), 3), "max_ms": round(max(ms), 3), "runs": len(ms)}
+
+
+def ingest(path: str, directory: str, transactions: int, seed: int) -> dict:
+    """
+    Generates every source and loads it through the real store() functions. Only the loads are timed.
+    """
+    counts = synthetic.split(transactions)
+    amex_paths = synthetic.write_amex_csvs(directory, counts.amex, seed)
+    expenses = synthetic.splitwise_expenses(counts.splitwise, seed)
+
+    results = {}
+    conn = db.connect(path)
+    with bulk.load_pragmas(conn):
+        stats, seconds = timed(amex.store, conn, amex_paths)
+        results["amex"] = {"rows": stats.rows, "seconds": round(seconds, 3)}
+
+        stats, seconds = bulk.UpsertStats(), 0.0
+        records = synthetic.monzo_records(counts.monzo, seed)
+        while chunk := list(islice(records, MONZO_CHUNK)):
+            chunk_stats, chunk_seconds = timed(monzo.store, conn, chunk)
+            stats, seconds = stats + chunk_stats, seconds + chunk_seconds
+        results["monzo"] = {"rows": stats.rows, "seconds": round(seconds, 3)}
+
+        stats, seconds = timed(splitwise.store, conn, expenses, None)
+        results["splitwise"] = {"rows": stats.rows, "seconds": round(seconds, 3)}
+        categories.create_table(conn.cursor())
+        conn.commit()
+    conn.close()
+    for result in results.values():
+        result["rows_per_second"] = round(result["rows"] / result["seconds"]) if result["seconds"] else None
+    return results
+
+
+def monzo_sync(directory: str, transactions: int, seed: int) -> dict:
+    """
+    A first (full) sheet sync against a local worksheet, then a daily refresh after a few rows are appended.
+    The sheet is capped at MONZO_CHUNK rows to keep it in memory.
+    """
+    sheet_rows = min(synthetic.split(transactions).monzo, MONZO_CHUNK)
+    rows = list(synthetic.monzo_sheet_rows(synthetic.monzo_records(sheet_rows + DAILY_MONZO_ROWS, seed)))
+    worksheet = synthetic.LocalWorksheet(monzo.SHEET_COLUMNS, rows[:sheet_rows])
+    conn = db.connect(os.path.join(directory, "monzo_sync.db"))
+    result = {"sheet_rows": sheet_rows}
+    for label in ("full", "incremental"):
+        worksheet.cells_read = 0
+        stats, seconds = timed(monzo.sync, conn, worksheet)
+        result[label] = {"rows": stats.rows, "inserted": stats.inserted, "cells_read": worksheet.cells_read,
+                         "seconds": round(seconds, 3)}
+        worksheet.append_rows(rows[sheet_rows:])
+    conn.close()
+    return result
+
+
+def write_routes(client: TestClient, conn: sqlite3.Connection, repeat: int) -> dict:
+    """
+    Times every write route against `conn`, a throwaway copy of the database: categorizing one
+    transaction, with and without propagating to its merchant, categorizing several, and creating,
+    replacing and deleting a rule.
+    """
+    ids = [row[0] for row in conn.execute(
+        "SELECT transaction_id FROM transactions_with_category ORDER BY transaction_id LIMIT ?", (CATEGORIZE_MULTIPLE_IDS,))]
+    timings = {label: [] for label in ("PUT /categorize/", "PUT /categorize/ propagate", "PUT /categorize_multiple/",
+                                       "POST /rules/", "PUT /rules/{id}", "DELETE /rules/{id}")}
+    statuses = {}
+
+    def call(label, method, url, body=None):
+        response, seconds = timed(client.request, method, url, json=body)
+        timings[label].append(seconds)
+        statuses[label] = response.status_code
+        return response
+
+    for i in range(repeat):
+        transaction_id = ids[i % len(ids)]
+        call("PUT /categorize/", "PUT", "/categorize/", {"transaction_id": transaction_id, "user_category": "GIFTS"})
+        call("PUT /categorize/ propagate", "PUT", "/categorize/",
+             {"transaction_id": transaction_id, "user_category": "SHOPPING", "propagate_to_merchant": True})
+        call("PUT /categorize_multiple/", "PUT", "/categorize_multiple/", {"transaction_ids": ids, "user_category": "BILLS"})
+        rule = {"pattern": "tesco", "category": "SHOPPING", "priority": 0}
+        rule_id = call("POST /rules/", "POST", "/rules/", rule).json()["rule"]["id"]
+        call("PUT /rules/{id}", "PUT", f"/rules/{rule_id}", {**rule, "pattern": "sainsbury"})
+        call("DELETE /rules/{id}", "DELETE", f"/rules/{rule_id}")
+    return {label: {"status": statuses[label], "uncached": summary(seconds)} for label, seconds in timings.items()}
+
+
+def run(transactions: int, materialize: bool, repeat: int, seed: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "transactions.db")
+        result = {"transactions": transactions, "materialized": materialize, "seed": seed}
+        result["ingest"] = ingest(path, directory, transactions, seed)
+        result["monzo_sync"] = monzo_sync(directory, transactions, seed)
+        _, seconds = timed(views.main, materialize, path)
+        result["views_main_seconds"] = round(seconds, 3)
+
+        import app
+        conn = db.connect(path)
+        app.app.dependency_overrides[db.get_db] = lambda: conn
+        db.pool = db.ConnectionPool(path)  # the response cache reads the data version through the pool
+        with TestClient(app.app) as client:
+            cursor = conn.cursor()
+            result["pull_transactions"] = {
+                "uncategorized": summary([timed(categories.pull_transactions, cursor, None, True)[1] for _ in range(repeat)]),
+                "month": summary([timed(categories.pull_transactions, cursor, "2024-03", False)[1] for _ in range(repeat)]),
+            }
+
+            response, seconds = timed(client.put, "/auto_categorize/")
+            result["auto_categorize"] = {"seconds": round(seconds, 3), "categorized": sum(response.json()["categories"].values())}
+
+            result["routes"] = {}
+            for label, method, url, params in ROUTES:
+                cold, warm, status = [], [], None
+                for _ in range(repeat):
+                    cache.clear()
+                    response, seconds = timed(client.request, method, url, params=params)
+                    cold.append(seconds)
+                    status = response.status_code
+                    if response.headers.get("x-cache"):
+                        warm.append(timed(client.request, method, url, params=params)[1])
+                result["routes"][label] = {"status": status, "uncached": summary(cold)}
+                if warm:
+                    result["routes"][label]["cached"] = summary(warm)
+
+            copy = db.connect(os.path.join(directory, "writes.db"))
+            conn.backup(copy)
+            app.app.dependency_overrides[db.get_db] = lambda: copy
+            result["routes"].update(write_routes(client, copy, repeat))
+            copy.close()
+        app.app.dependency_overrides.clear()
+        conn.close()
+        result["db_bytes"] = os.path.getsize(path)
+    return result
+
+
+def main(scales, materialize_modes, repeat: int, seed: int, output: str):
+    runs = []
+    for transactions in scales:
+        for materialize in materialize_modes:
+            # Progress goes to stderr; stdout may be the JSON report
+            print(f"benchmark: {transactions} transactions, materialized={materialize}", file=sys.stderr)
+            runs.append(run(transactions, materialize, repeat, seed))
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "runs": runs,
+    }
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load synthetic data through the real loaders and time ingestion, "
+                                                 "categorization and every API route. Emits JSON.")
+    parser.add_argument("--scale", type=int, action="append",
+                        help="Total transactions to generate; repeat for several runs (default 10000).")
+    parser.add_argument("--materialize", action=argparse.BooleanOptionalAction, default=None,
+                        help="Only benchmark the materialized (or only the view-based) mode. Default: both.")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed calls per query or route.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="File for the JSON report; '-' for stdout.")
+    args = parser.parse_args()
+    main(args.scale or [10000], [True, False] if args.materialize is None else [args.materialize],
+         args.repeat, args.seed, args.output)
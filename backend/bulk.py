@@ -0,0 +1,128 @@
+import hashlib
+import json
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Iterable, List, Optional, Sequence
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+@dataclass
+class UpsertStats:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    changed_keys: List = field(default_factory=list)  # primary keys of inserted and updated rows
+
+    @property
+    def rows(self) -> int:
+        return self.inserted + self.updated + self.unchanged
+
+    def __add__(self, other: "UpsertStats") -> "UpsertStats":
+        return UpsertStats(self.inserted + other.inserted, self.updated + other.updated,
+                           self.unchanged + other.unchanged, self.changed_keys + other.changed_keys)
+
+
+@contextmanager
+def load_pragmas(conn: sqlite3.Connection, journal_mode: str = "WAL", synchronous: str = "OFF"):
+    """
+    Relax durability for the duration of a bulk load. The raw tables can always be rebuilt from
+    the source exports, so a crash mid-load only costs a re-run. `synchronous` is restored on exit.
+    """
+    previous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    try:
+        yield conn
+    finally:
+        conn.execute(f"PRAGMA synchronous = {previous}")
+
+
+def ensure_column(cursor: sqlite3.Cursor, table: str, column: str, column_type: str) -> bool:
+    """
+    Adds a column to a table created before the column existed. Returns True if it was added.
+    """
+    if column in {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    return True
+
+
+def date_keys(moment: Optional[datetime]) -> tuple:
+    """
+    The (timestamp, month) pair every raw table stores next to its source date: UTC epoch seconds
+    and 'YYYY-MM'. Naive datetimes are taken as UTC. (None, None) when the date is missing.
+    """
+    if moment is None:
+        return None, None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc)
+    return int(moment.timestamp()), moment.strftime("%Y-%m")
+
+
+def parse_date_keys(texts: Iterable[Optional[str]], date_format: str) -> List[tuple]:
+    """
+    date_keys() for every date string in `texts`, parsing each distinct string only once.
+    Missing or unparseable dates give (None, None).
+    """
+    cache = {}
+    keys = []
+    for text in texts:
+        if text not in cache:
+            try:
+                cache[text] = date_keys(datetime.strptime(text, date_format))
+            except (TypeError, ValueError):
+                cache[text] = (None, None)
+        keys.append(cache[text])
+    return keys
+
+
+def content_hash(row: Sequence) -> str:
+    return hashlib.blake2b(json.dumps(row, default=str).encode(), digest_size=16).hexdigest()
+
+
+def with_hash(row: Sequence) -> tuple:
+    """
+    Appends the content hash, which every raw UPSERT_SQL takes as its last parameter.
+    """
+    return (*row, content_hash(row))
+
+
+def batched(rows: Iterable[Sequence], batch_size: int):
+    iterator = iter(rows)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def bulk_upsert(cursor: sqlite3.Cursor, raw, rows: Iterable[Sequence], batch_size: int = DEFAULT_BATCH_SIZE) -> UpsertStats:
+    """
+    Upserts `rows` (raw.to_row() tuples) into raw.TABLE, one executemany per batch, skipping rows
+    whose content hash matches the stored one. `raw` is one of the *RawTransaction classes.
+    No commit is issued, so every batch lands in the caller's transaction.
+    """
+    stats = UpsertStats()
+    for batch in batched(rows, batch_size):
+        keys = [row[raw.KEY_INDEX] for row in batch]
+        stored = dict(cursor.execute(
+            f"SELECT {raw.KEY}, content_hash FROM {raw.TABLE} WHERE {raw.KEY} IN (SELECT value FROM json_each(?))",
+            (json.dumps(keys),)
+        ))
+        changed = []
+        for key, row in zip(keys, batch):
+            row = with_hash(row)
+            if key not in stored:
+                stats.inserted += 1
+            elif stored[key] != row[-1]:
+                stats.updated += 1
+            else:
+                stats.unchanged += 1
+                continue
+            stored[key] = row[-1]
+            stats.changed_keys.append(key)
+            changed.append(row)
+        cursor.executemany(raw.UPSERT_SQL, changed)
+    return stats
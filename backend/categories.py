@@ -1,7 +1,20 @@
+import json
+import logging
+import re
 import sqlite3
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-import sqlglot
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import bulk
+import classifier
+import merchants
+import queries
+import rules
+import sync_state
+
+logger = logging.getLogger(__name__)
 
 
 class Category(str, Enum):
@@ -31,38 +44,46 @@ class Category(str, Enum):
 
     @classmethod
     def guess_category(cls, description: str):
-        cleaned = description.lower().replace(' ', '')
-        if any(substring in cleaned for substring in
-               ['amazon', 'waterstones', 'houseofbooks', 'amznmktplace', 'etika', 'oxfam', 'hardware', 'b&q', 'googlegoogle', 'dunelm', 'book']):
-            return cls.SHOPPING
-        elif any(substring in cleaned for substring in
-                 ['tesco', 'sainsbur', 'waitro', 'm&s', 'co-op', 'crouchhillsupermarket', 'wmmor', 'morris', 'lidl', 'groceries', 'co-pp']):
-            return cls.GROCERIES
-        elif any(substring in cleaned for substring in ['tfl', 'humanforest', 'transportforlondon', 'lime*']):
-            return cls.TRANSPORT
-        elif any(substring in cleaned for substring in ['gympass', 'barber', 'sportsshoes', 'florencehickmanyoga', 'castleclim', 'londonfieldstriath', 'www.better', 'archwaycuts']):
-            return cls.PERSONAL_CARE
-        elif any(substring in cleaned for substring in
-                 ['paymentreceived', 'payment', 'settleallbalances', 'americanexp', 'flatexpenses', 'finglandsplitwise']):
-            return cls.TRANSFERS
-        elif any(substring in cleaned for substring in
-                 ['avanti', 'gwr', 'trainline', 'holidaypot', 'monzopremium', 'lner', 'mta', 'holid', 'fuel', 'travelinsurance']):
-            return cls.TRAVEL
-        elif any(substring in cleaned for substring in ['haringey', 'movingpot', 'water', 'utilities', 'health+dental', 'vodafone', 'thameswater', 'londonboroughofharingey', 'londonboroughofislington', 'counciltax', 'rent', 'virginmedia', 'arimaproperties', 'bills', 'wifi', 'waterbill']):
-            return cls.BILLS
-        elif any(substring in cleaned for substring in ['s&s']):
-            return cls.ISA
-        elif any(substring in cleaned for substring in ['gail', 'theroyalstar', 'pret']):
-            return cls.EATING_OUT
-        elif any(substring in cleaned for substring in ['checkout']):
-            return cls.INCOME
-        elif any(substring in cleaned for substring in ['christmaspot']):
-            return cls.GIFTS
-        return cls.UNKNOWN
+        """
+        Category of the built-in keyword rules, without any rules edited in the database.
+        """
+        rule = KEYWORD_RULES.match(description)
+        return cls(rule.category) if rule else cls.UNKNOWN
+
+    @classmethod
+    def guess_categories(cls, descriptions: Iterable[str]) -> List["Category"]:
+        """
+        Batch version of guess_category. Repeated descriptions (the same merchant month after month)
+        are only matched once.
+        """
+        return [cls.guess_category(description) for description in descriptions]
+
+
+# Keyword rules in priority order: the first category with any keyword in the description wins.
+# They seed the category_rules table of a new database, where they can then be edited.
+CATEGORY_KEYWORDS = [
+    (Category.SHOPPING, ['amazon', 'waterstones', 'houseofbooks', 'amznmktplace', 'etika', 'oxfam', 'hardware', 'b&q', 'googlegoogle', 'dunelm', 'book']),
+    (Category.GROCERIES, ['tesco', 'sainsbur', 'waitro', 'm&s', 'co-op', 'crouchhillsupermarket', 'wmmor', 'morris', 'lidl', 'groceries', 'co-pp']),
+    (Category.TRANSPORT, ['tfl', 'humanforest', 'transportforlondon', 'lime*']),
+    (Category.PERSONAL_CARE, ['gympass', 'barber', 'sportsshoes', 'florencehickmanyoga', 'castleclim', 'londonfieldstriath', 'www.better', 'archwaycuts']),
+    (Category.TRANSFERS, ['paymentreceived', 'payment', 'settleallbalances', 'americanexp', 'flatexpenses', 'finglandsplitwise']),
+    (Category.TRAVEL, ['avanti', 'gwr', 'trainline', 'holidaypot', 'monzopremium', 'lner', 'mta', 'holid', 'fuel', 'travelinsurance']),
+    (Category.BILLS, ['haringey', 'movingpot', 'water', 'utilities', 'health+dental', 'vodafone', 'thameswater', 'londonboroughofharingey', 'londonboroughofislington', 'counciltax', 'rent', 'virginmedia', 'arimaproperties', 'bills', 'wifi', 'waterbill']),
+    (Category.ISA, ['s&s']),
+    (Category.EATING_OUT, ['gail', 'theroyalstar', 'pret']),
+    (Category.INCOME, ['checkout']),
+    (Category.GIFTS, ['christmaspot']),
+]
+
+
+KEYWORD_RULES = rules.RuleMatcher(rules.seed_rules(CATEGORY_KEYWORDS))
 
 
 CATEGORY_TYPES = [c for c in Category.__members__]
 
+# Rule matches carry no probability; this ranks them below any prediction the categorizer is trusted with
+RULE_CONFIDENCE = 0.5
+
 
 def create_table(cursor: sqlite3.Cursor):
     """
@@ -74,76 +95,327 @@ def create_table(cursor: sqlite3.Cursor):
         user_category TEXT,
         model_category TEXT,
         model_confidence REAL,
+        propagated_from TEXT,  -- the transaction the user categorized, when the category was propagated from it
         update_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     """)
+    # Rows from before the column are left unmarked: rule categories share the full confidence of
+    # propagated ones, so the two cannot be told apart and both stay open to re-evaluation
+    bulk.ensure_column(cursor, "categories", "propagated_from", "TEXT")
+    # The categorizer reads the user labels changed since it was last trained
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_categories_user_labels ON categories (update_timestamp)
+    WHERE user_category IS NOT NULL
+    """)
+    rules.create_table(cursor, rules.seed_rules(CATEGORY_KEYWORDS))
+
+
+def month_bounds(month: str) -> Tuple[int, int]:
+    """
+    Epoch seconds (UTC) of the start of `month` (YYYY-MM) and of the month after it.
+    """
+    start = datetime.strptime(month, '%Y-%m').replace(tzinfo=timezone.utc)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+# Transactions before this are never offered for categorization
+HISTORY_START, _ = month_bounds('2022-09')
 
 
 def pull_transactions(cursor: sqlite3.Cursor, month: str = None, uncategorized_only: bool = True):
-    print(f"Pulling transactions for {month} with uncategorized_only={uncategorized_only}")
-    query = (
-        sqlglot.select(
-            "transaction_id",
-            "strftime('%Y-%m-%d', timestamp, 'unixepoch') AS date",
-            "description",
-            "amount",
-            "account",
-            "category"
-        )
-        .from_("transactions_with_category")
-        .where("date >= '2022-09-01'")
-    )
+    logger.debug("Pulling transactions for %s with uncategorized_only=%s", month, uncategorized_only)
+    params = {"history_start": HISTORY_START}
+    if month:
+        params["start"], params["end"] = month_bounds(month)
+
+    cursor.execute(queries.transactions_query(uncategorized_only, bool(month)), params)
+    return cursor.fetchall()
+
+
+def pull_transaction_page(cursor: sqlite3.Cursor, limit: int, after: Optional[Tuple[int, str]] = None,
+                          start: Optional[int] = None, end: Optional[int] = None,
+                          account: Optional[str] = None, category: Optional[str] = None,
+                          min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                          uncategorized_only: bool = False):
+    """
+    One page of transactions, newest first, ordered by (timestamp, transaction_id). `after` is the
+    key of the last row of the previous page; `start` is inclusive and `end` exclusive (epoch seconds).
+    Rows without a timestamp (an unparseable date) have no place in the key order and are left out.
+    Fetches one extra row so the caller can tell whether another page exists.
+    """
+    clauses, params = ["timestamp IS NOT NULL"], []
+    if after:
+        clauses.append("(timestamp, transaction_id) < (?, ?)")
+        params += [after[0], after[1]]
+    if start is not None:
+        clauses.append("timestamp >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("timestamp < ?")
+        params.append(end)
+    if account:
+        clauses.append("account = ?")
+        params.append(account.upper())
+    if category:
+        clauses.append("category = ?")
+        params.append(category.upper())
     if uncategorized_only:
-        query = query.where("category IS NULL")
+        clauses.append("category IS NULL")
+    if min_amount is not None:
+        clauses.append("amount >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        clauses.append("amount <= ?")
+        params.append(max_amount)
 
-    if month:
-        query = query.where(f"strftime('%Y-%m', date) = '{month}'")
+    cursor.execute(f"""
+        SELECT
+            transaction_id,
+            timestamp,
+            strftime('%Y-%m-%d', timestamp, 'unixepoch') AS date,
+            description,
+            amount,
+            account,
+            category
+        FROM transactions_with_category
+        WHERE {' AND '.join(clauses)}
+        ORDER BY timestamp DESC, transaction_id DESC
+        LIMIT ?
+    """, (*params, limit + 1))
+    return cursor.fetchall()
+
+
+def scan_transactions(cursor: sqlite3.Cursor, terms: List[str], limit: int):
+    """
+    Transactions whose description or address contains every term, newest first, without an index.
+    """
+    text = "lower(coalesce(description, '') || ' ' || coalesce(address, ''))"
+    cursor.execute(f"""
+        SELECT
+            transaction_id,
+            strftime('%Y-%m-%d', timestamp, 'unixepoch') AS date,
+            description,
+            amount,
+            account,
+            category
+        FROM transactions_with_category
+        WHERE {' AND '.join(f"instr({text}, ?) > 0" for _ in terms)}
+        ORDER BY timestamp DESC, transaction_id DESC
+        LIMIT ?
+    """, (*(term.lower() for term in terms), limit))
+    return cursor.fetchall()
 
-    query = query.order_by("timestamp DESC")
 
-    cursor.execute(query.sql("sqlite"))
-    print(query.sql("sqlite"))
+def search_transactions(cursor: sqlite3.Cursor, text: str, limit: int = 50):
+    """
+    Ranked full-text search over descriptions and addresses. Every word in `text` must match,
+    each as a prefix, so "tes sto" finds "TESCO STORES". The index is kept in materialized mode;
+    a database built with --no-materialize is scanned instead, matching each word anywhere.
+    """
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return []
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_fts'")
+    if cursor.fetchone() is None:
+        return scan_transactions(cursor, terms, limit)
+    cursor.execute("""
+        SELECT
+            t.transaction_id,
+            strftime('%Y-%m-%d', t.timestamp, 'unixepoch') AS date,
+            t.description,
+            t.amount,
+            t.account,
+            t.category
+        FROM transactions_fts
+        JOIN transactions t ON t.rowid = transactions_fts.rowid
+        WHERE transactions_fts MATCH ?
+        ORDER BY bm25(transactions_fts, 2.0, 1.0)
+        LIMIT ?
+    """, (' '.join(f'"{term}"*' for term in terms), limit))
     return cursor.fetchall()
 
 
+MODEL_CATEGORY_UPSERT = '''
+        INSERT INTO categories (transaction_id, model_category, model_confidence) 
+        VALUES (?, ?, ?)
+        ON CONFLICT(transaction_id) DO UPDATE SET
+                model_category=excluded.model_category,
+                model_confidence=excluded.model_confidence,
+                propagated_from=NULL,
+                update_timestamp=CURRENT_TIMESTAMP
+        '''
+
+# Like MODEL_CATEGORY_UPSERT, but leaves any transaction the user has categorized, directly or by
+# propagating a category to its merchant, alone
+REEVALUATED_CATEGORY_UPSERT = '''
+        INSERT INTO categories (transaction_id, model_category, model_confidence)
+        VALUES (?, ?, ?)
+        ON CONFLICT(transaction_id) DO UPDATE SET
+                model_category=excluded.model_category,
+                model_confidence=excluded.model_confidence,
+                update_timestamp=CURRENT_TIMESTAMP
+        WHERE user_category IS NULL AND propagated_from IS NULL
+        '''
+
+USER_CATEGORY_UPSERT = '''
+        INSERT INTO categories (transaction_id, user_category) 
+        VALUES (?, ?)
+        ON CONFLICT(transaction_id) DO UPDATE SET
+                user_category=excluded.user_category,
+                update_timestamp=CURRENT_TIMESTAMP
+        '''
+
+
+# Gives the other transactions of a merchant the category a user picked for one of them. Written as a
+# certain model category, so it never overrides a category the user set and is not a training label,
+# and marked with the transaction it came from so rule changes leave it alone.
+MERCHANT_CATEGORY_UPSERT = '''
+        INSERT INTO categories (transaction_id, model_category, model_confidence, propagated_from)
+        SELECT transaction_id, ?, 1.0, ?
+        FROM transaction_merchants
+        WHERE merchant = (SELECT merchant FROM transaction_merchants WHERE transaction_id = ?)
+            AND transaction_id != ?
+        ON CONFLICT(transaction_id) DO UPDATE SET
+                model_category=excluded.model_category,
+                model_confidence=excluded.model_confidence,
+                propagated_from=excluded.propagated_from,
+                update_timestamp=CURRENT_TIMESTAMP
+        WHERE user_category IS NULL
+            AND (model_category IS NOT excluded.model_category OR model_confidence IS NOT excluded.model_confidence
+                 OR propagated_from IS NOT excluded.propagated_from)
+        '''
+
+
 def update_categories(transaction_id,  cursor: sqlite3.Cursor, model_category: str = None, model_confidence: float = None, user_category: str = None):
     if model_category and not model_confidence:
         raise ValueError("Model category requires model confidence")
     if model_confidence and not model_category:
         raise ValueError("Model confidence requires model category")
     if model_category and model_confidence:
-        cursor.execute('''
-                INSERT INTO categories (transaction_id, model_category, model_confidence) 
-                VALUES (?, ?, ?)
-                ON CONFLICT(transaction_id) DO UPDATE SET
-                        model_category=excluded.model_category,
-                        model_confidence=excluded.model_confidence,
-                        update_timestamp=CURRENT_TIMESTAMP
-                ''', (transaction_id, model_category, model_confidence))
+        cursor.execute(MODEL_CATEGORY_UPSERT, (transaction_id, model_category, model_confidence))
         return
     if user_category:
-        cursor.execute('''
-                INSERT INTO categories (transaction_id, user_category) 
-                VALUES (?, ?)
-                ON CONFLICT(transaction_id) DO UPDATE SET
-                        user_category=excluded.user_category,
-                        update_timestamp=CURRENT_TIMESTAMP
-                ''', (transaction_id, user_category))
-        print(f"Updated {transaction_id} with category {user_category}")
+        cursor.execute(USER_CATEGORY_UPSERT, (transaction_id, user_category))
+        logger.debug("Updated %s with category %s", transaction_id, user_category)
         return
     raise ValueError("No category provided")
 
 
+def categorize_many(cursor: sqlite3.Cursor, transaction_ids: Iterable[str], user_category: str) -> Tuple[int, List[str]]:
+    """
+    Sets the user category of every known id with one lookup and one executemany.
+    Returns the number of transactions updated and the ids that matched no transaction.
+    """
+    transaction_ids = list(dict.fromkeys(transaction_ids))  # de-duplicated, in request order
+    cursor.execute("""
+        SELECT transaction_id FROM transactions_with_category
+        WHERE transaction_id IN (SELECT value FROM json_each(?))
+    """, (json.dumps(transaction_ids),))
+    known = {row[0] for row in cursor.fetchall()}
+    cursor.executemany(USER_CATEGORY_UPSERT, [(transaction_id, user_category) for transaction_id in transaction_ids if transaction_id in known])
+    return len(known), [transaction_id for transaction_id in transaction_ids if transaction_id not in known]
+
+
+def classify(cursor: sqlite3.Cursor, transactions: List[Tuple[Optional[str], Optional[str], Optional[str], Optional[float]]]) -> List[Tuple[Optional[str], float]]:
+    """
+    (category, confidence) per (merchant, description, account, amount): the learned categorizer,
+    which is trained on merchants, where it is confident enough, otherwise the best category rule
+    matching the full description, otherwise (None, 0.0). The rules see the whole description since
+    keywords can sit in words the merchant key drops. Each distinct merchant is scored and each
+    distinct description matched once; only the rules' account and amount filters run per row.
+    """
+    predictions = classifier.train(cursor).predict(merchant or description for merchant, description, _, _ in transactions)
+    matcher = rules.matcher(cursor)
+    results = []
+    for (_, description, account, amount), (label, confidence) in zip(transactions, predictions):
+        if label is not None and confidence >= classifier.MIN_CONFIDENCE:
+            results.append((label, confidence))
+        elif (rule := matcher.match(description, account, amount)) is not None:
+            results.append((rule.category, RULE_CONFIDENCE))
+        else:
+            results.append((None, 0.0))
+    return results
+
+
+def propagate_to_merchant(cursor: sqlite3.Cursor, transaction_id: str, user_category: str) -> int:
+    """
+    Applies a user category to the rest of the transaction's merchant history in one statement.
+    Returns the number of transactions changed.
+    """
+    cursor.execute(MERCHANT_CATEGORY_UPSERT, (user_category, transaction_id, transaction_id, transaction_id))
+    return cursor.rowcount
+
+
 def run_model(transaction_id: str, description: str, cursor: sqlite3.Cursor):
-    model_category = Category.guess_category(description)
-    if model_category == Category.UNKNOWN:
+    [(model_category, model_confidence)] = classify(cursor, [(merchants.merchant_key(description), description, None, None)])
+    if model_category is None:
         return False
 
-    update_categories(transaction_id, cursor, model_category=model_category, model_confidence=1.0)
-    print(f"Updated {transaction_id} with category {model_category}")
+    update_categories(transaction_id, cursor, model_category=model_category, model_confidence=model_confidence)
+    logger.debug("Updated %s with category %s", transaction_id, model_category)
     return True
 
 
+def run_model_batch(cursor: sqlite3.Cursor) -> Dict[str, int]:
+    """
+    Classify every uncategorized transaction in memory and write the results with one executemany.
+    The categorizer scores each distinct merchant once and the rules match each distinct description
+    once, fanning the results out to every transaction sharing them.
+    Returns the number of transactions assigned to each category.
+    """
+    cursor.execute("""
+        SELECT t.transaction_id, m.merchant, t.description, t.account, t.amount
+        FROM transactions_with_category t
+        LEFT JOIN transaction_merchants m USING (transaction_id)
+        WHERE t.category IS NULL AND t.timestamp >= ?
+    """, (HISTORY_START,))
+    transactions = cursor.fetchall()
+    predictions = classify(cursor, [tuple(row)[1:] for row in transactions])
+    updates = [
+        (transaction_id, category, confidence)
+        for (transaction_id, *_), (category, confidence) in zip(transactions, predictions)
+        if category is not None
+    ]
+    cursor.executemany(MODEL_CATEGORY_UPSERT, updates)
+    return dict(Counter(category for _, category, _ in updates))
+
+
+def reapply_rules(cursor: sqlite3.Cursor, patterns: Iterable[str]) -> Dict[str, int]:
+    """
+    Re-evaluates the transactions a rule change could affect: those without a user category, set
+    directly or propagated to their merchant, whose description contains one of `patterns`, the old and new patterns of the changed rules. Only rows
+    whose outcome changes are written; a row no rule or prediction covers any more loses its model
+    category. Returns the number of transactions evaluated and changed.
+    """
+    patterns = {rules.clean_text(pattern) for pattern in patterns} - {''}
+    cursor.execute("""
+        SELECT DISTINCT t.description FROM transactions_with_category t
+        LEFT JOIN categories c USING (transaction_id)
+        WHERE t.user_category IS NULL AND c.propagated_from IS NULL AND t.timestamp >= ?
+    """, (HISTORY_START,))
+    affected = [description for (description,) in cursor.fetchall() if any(p in rules.clean_text(description) for p in patterns)]
+    if not affected:
+        return {"evaluated": 0, "changed": 0}
+    cursor.execute("""
+        SELECT t.transaction_id, m.merchant, t.description, t.account, t.amount, t.model_category, t.model_confidence
+        FROM transactions_with_category t
+        LEFT JOIN transaction_merchants m USING (transaction_id)
+        LEFT JOIN categories c USING (transaction_id)
+        WHERE t.description IN (SELECT value FROM json_each(?))
+            AND t.user_category IS NULL AND c.propagated_from IS NULL AND t.timestamp >= ?
+    """, (json.dumps(affected), HISTORY_START))
+    transactions = cursor.fetchall()
+    predictions = classify(cursor, [tuple(row)[1:5] for row in transactions])
+    updates = [
+        (transaction_id, category, confidence if category is not None else None)
+        for (transaction_id, _, _, _, _, *current), (category, confidence) in zip(transactions, predictions)
+        if current != [category, confidence if category is not None else None]
+    ]
+    cursor.executemany(REEVALUATED_CATEGORY_UPSERT, updates)
+    return {"evaluated": len(transactions), "changed": len(updates)}
+
+
 def ask_user(transaction_id: str, description: str, timestamp: int, amount: float, cursor: sqlite3.Cursor):
     print(f"Transaction: {description} at {datetime.fromtimestamp(timestamp)} for {amount}")
     print("Please enter the category:")
@@ -162,9 +434,9 @@ if __name__ == '__main__':
     conn = sqlite3.connect('../db/transactions.db')
     cursor = conn.cursor()
 
-    results = [run_model(tx[0], tx[2], cursor) for tx in pull_transactions(cursor)]
-    print(f"Updated {sum(results)} transactions")
-    print(f"Model couldn't classify {len(results) - sum(results)} transactions")
+    counts = run_model_batch(cursor)
+    print(f"Updated {sum(counts.values())} transactions")
+    print(f"Model couldn't classify {len(pull_transactions(cursor))} transactions")
 
     user_classified = []
     try:
@@ -175,5 +447,6 @@ if __name__ == '__main__':
         print("Exiting")
 
     print(f"Updated {sum(user_classified)} transactions via user input")
+    sync_state.bump_data_version(cursor)
     conn.commit()
     conn.close()
\ No newline at end of file
@@ -0,0 +1,146 @@
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import List
+
+from fastapi.testclient import TestClient
+
+import amex
+import bulk
+import categories
+import db
+import merchants
+import monzo
+import splitwise
+import synthetic
+import views
+
+# Tables that grow with the transaction history; a plain SCAN of one of them on a hot path is a regression.
+# monthly_rollup is bounded by months x categories x accounts and may be scanned.
+LARGE_TABLES = {"amex_raw", "monzo_raw", "splitwise_raw", "categories", "transactions", "transaction_merchants", "splitwise_shares"}
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+AMEX_ID = next(synthetic.amex_rows(1))[9]
+MONZO_ID = next(synthetic.monzo_records(1))["Transaction ID"]
+
+# (method, path, query params, json body) for every request-path query worth guarding.
+# An unfiltered /total sums every row by design and is deliberately left out.
+REQUESTS = [
+    ("GET", "/transactions/", {"month": "2024-03", "uncategorized": True}, None),
+    ("GET", "/transactions/", {"uncategorized": False}, None),
+    ("GET", "/transactions/page", {"limit": 50}, None),
+    ("GET", "/transactions/page", {"limit": 50, "cursor": "WzE3MDAwMDAwMDAsICJ4Il0="}, None),
+    ("GET", "/transactions/page", {"start_date": "2024-01-01", "end_date": "2024-03-31"}, None),
+    ("GET", "/transactions/page", {"account": "amex"}, None),
+    ("GET", "/transactions/page", {"category": "groceries"}, None),
+    ("GET", "/transactions/page", {"uncategorized": True}, None),
+    ("GET", "/search", {"q": "tes sto"}, None),
+    ("GET", "/categories/", None, None),
+    ("GET", "/pivot_data", None, None),
+    ("GET", "/total", {"category": "GROCERIES"}, None),
+    ("GET", "/category_spend", {"category": "GROCERIES"}, None),
+    ("GET", "/category_spend/batch", [("category", "GROCERIES"), ("category", "BILLS")], None),
+    ("PUT", "/categorize/", None, {"transaction_id": AMEX_ID, "user_category": "GIFTS"}),
+    ("PUT", "/categorize/", None, {"transaction_id": MONZO_ID, "user_category": "GIFTS", "propagate_to_merchant": True}),
+    ("PUT", "/categorize_multiple/", None, {"transaction_ids": [AMEX_ID, MONZO_ID, "nope"], "user_category": "GIFTS"}),
+    ("PUT", "/auto_categorize/", None, None),
+    ("GET", "/rules/", None, None),
+    ("POST", "/rules/", None, {"pattern": "tesco", "category": "GROCERIES", "priority": 0, "account": "AMEX", "max_amount": 0}),
+]
+
+
+def synthetic_db(path: str, transactions: int = 1000):
+    """
+    A small materialized database with every source loaded through the real loaders.
+    """
+    counts = synthetic.split(transactions)
+    conn = db.connect(path)
+    amex.store(conn, synthetic.write_amex_csvs(os.path.dirname(path), counts.amex))
+    monzo.store(conn, list(synthetic.monzo_records(counts.monzo)))
+    splitwise.store(conn, synthetic.splitwise_expenses(counts.splitwise), None)
+    categories.create_table(conn.cursor())
+    conn.commit()
+    conn.close()
+    views.main(True, path)
+
+
+def loader_paths(conn: sqlite3.Connection):
+    """
+    The per-import queries: the stored-hash lookup of bulk_upsert, and refresh_transactions and
+    merchants.refresh for every source.
+    """
+    cursor = conn.cursor()
+    row = amex.AmexRawTransaction(*next(synthetic.amex_rows(1))).to_row()
+    yield "bulk_upsert amex_raw", lambda: bulk.bulk_upsert(cursor, amex.AmexRawTransaction, [row])
+    for account, key in [("AMEX", AMEX_ID), ("MONZO", MONZO_ID), ("SPLITWISE", 0)]:
+        yield f"refresh_transactions {account}", lambda account=account, key=key: views.refresh_transactions(cursor, account, [key])
+        yield f"merchants.refresh {account}", lambda account=account, key=key: merchants.refresh(cursor, account, [key])
+
+
+def explain(conn: sqlite3.Connection, statements):
+    """
+    (statement, plan lines) for every traced statement that has a plan.
+    """
+    for statement in statements:
+        if statement.startswith("--") or not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)", statement, re.I):
+            continue
+        yield statement, [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}")]
+
+
+def check(verbose: bool = False) -> List[str]:
+    """
+    Runs every request and loader path against a fresh synthetic database, printing one line each.
+    Returns the failures: paths that errored or planned a full scan of a large table.
+    """
+    import app
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "transactions.db")
+        synthetic_db(path)
+        conn = db.connect(path)
+        statements = []
+        conn.set_trace_callback(statements.append)
+        app.app.dependency_overrides[db.get_db] = lambda: conn
+        db.pool = db.ConnectionPool(path)  # the response cache reads the data version through the pool
+
+        checks = [(f"{method} {url} {params or body or ''}",
+                   lambda method=method, url=url, params=params, body=body: client.request(method, url, params=params, json=body))
+                  for method, url, params, body in REQUESTS]
+        checks += list(loader_paths(conn))
+
+        failures = []
+        with TestClient(app.app) as client:
+            for name, run in checks:
+                statements.clear()
+                response = run()
+                conn.commit()
+                if getattr(response, "status_code", 200) >= 400:
+                    failures.append(f"ERROR {name}: HTTP {response.status_code}")
+                    print(failures[-1])
+                    continue
+                conn.set_trace_callback(None)
+                scans = []
+                for statement, plan in explain(conn, list(statements)):
+                    scans += [match.group(1) for line in plan if (match := FULL_SCAN.match(line)) and match.group(1) in LARGE_TABLES]
+                    if verbose:
+                        print(f"  {' '.join(statement.split())[:160]}\n    " + "\n    ".join(plan))
+                conn.set_trace_callback(statements.append)
+                print(f"{'FULL SCAN' if scans else 'ok':<10}{name}{' -> ' + ', '.join(sorted(set(scans))) if scans else ''}")
+                if scans:
+                    failures.append(f"FULL SCAN {name} -> {', '.join(sorted(set(scans)))}")
+        app.app.dependency_overrides.clear()
+        conn.close()
+    return failures
+
+
+def main(verbose: bool = False) -> int:
+    return 1 if check(verbose) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a hot-path query plans a full scan of a large table.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print every statement and its plan.")
+    sys.exit(main(parser.parse_args().verbose))
@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Bump when the features or the file layout change; a cached model of another version is retrained from scratch
+MODEL_VERSION = 3
+HASH_BUCKETS = 1 << 16
+NGRAM_SIZES = (3, 4, 5)
+ALPHA = 0.1  # additive smoothing of the per-class n-gram counts
+MIN_LABELS = 20  # with fewer user labels than this (or a single class) only the keyword rules are used
+MIN_CONFIDENCE = 0.6  # predictions below this fall back to the keyword rules
+PREDICT_BATCH = 4096  # descriptions scored per matrix operation
+
+# User labels changed since a model's trained_until, on the same merchant text predictions are made
+# from. update_timestamp has second precision, so the boundary second is read again and labels
+# already folded in are skipped.
+LABELS_SQL = """
+    SELECT c.transaction_id, coalesce(m.merchant, t.description), c.user_category, c.update_timestamp
+    FROM categories c
+    JOIN transactions_with_category t ON t.transaction_id = c.transaction_id
+    LEFT JOIN transaction_merchants m ON m.transaction_id = c.transaction_id
+    WHERE c.user_category IS NOT NULL AND c.update_timestamp >= ?
+"""
+
+_DIGITS = re.compile(r"\d+")
+_SEPARATORS = re.compile(r"[^a-z#]+")
+
+
+def features(description: Optional[str]) -> List[int]:
+    """
+    Hashed character 3-5 grams of the normalized description. Digit runs (store numbers, references)
+    collapse to one symbol so every branch of a merchant shares its features.
+    """
+    text = f" {_SEPARATORS.sub(' ', _DIGITS.sub('#', (description or '').lower())).strip()} "
+    grams = {text[i:i + n] for n in NGRAM_SIZES for i in range(len(text) - n + 1)}
+    # crc32 rather than hash(): the buckets have to be stable across processes for the cached counts
+    return sorted({zlib.crc32(gram.encode()) % HASH_BUCKETS for gram in grams})
+
+
+class NaiveBayes:
+    """
+    Naive Bayes over hashed n-gram presence. The counts are additive, so new and changed labels are
+    folded in without revisiting the others.
+    """
+    def __init__(self, classes: List[str] = None, counts: np.ndarray = None, docs: np.ndarray = None,
+                 labels: Dict[str, str] = None, trained_until: str = ""):
+        self.classes = list(classes or [])
+        self.counts = counts if counts is not None else np.zeros((0, HASH_BUCKETS), dtype=np.int32)  # n-grams per class
+        self.docs = docs if docs is not None else np.zeros(0, dtype=np.int64)  # labelled transactions per class
+        self.labels = dict(labels or {})  # transaction_id -> the label it was trained with
+        self.trained_until = trained_until  # newest categories.update_timestamp folded in
+        self._log_probs = None
+
+    def ready(self) -> bool:
+        return int((self.docs > 0).sum()) >= 2 and len(self.labels) >= MIN_LABELS
+
+    def _class_index(self, label: str) -> int:
+        if label not in self.classes:
+            self.classes.append(label)
+            self.counts = np.vstack([self.counts, np.zeros((1, HASH_BUCKETS), dtype=np.int32)])
+            self.docs = np.append(self.docs, 0)
+        return self.classes.index(label)
+
+    def update(self, rows: Iterable[Tuple[str, str, str, str]]) -> int:
+        """
+        Folds in (transaction_id, description, user_category, update_timestamp) rows. A transaction
+        whose label changed is moved from its old class. Returns the number of labels applied.
+        """
+        changed = 0
+        for transaction_id, description, label, updated in rows:
+            self.trained_until = max(self.trained_until, updated or "")
+            previous = self.labels.get(transaction_id)
+            if previous == label:
+                continue
+            grams = features(description)
+            if previous is not None:
+                old = self._class_index(previous)
+                self.counts[old, grams] -= 1
+                self.docs[old] -= 1
+            new = self._class_index(label)
+            self.counts[new, grams] += 1
+            self.docs[new] += 1
+            self.labels[transaction_id] = label
+            changed += 1
+        if changed:
+            self._log_probs = None
+        return changed
+
+    def log_probs(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (log prior per class, log P(n-gram | class) per class and bucket), computed once per update.
+        """
+        if self._log_probs is None:
+            prior = np.log(self.docs + 1.0) - np.log(self.docs.sum() + len(self.classes))
+            smoothed = self.counts + ALPHA
+            self._log_probs = prior, np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+        return self._log_probs
+
+    def predict(self, descriptions: Iterable[Optional[str]]) -> List[Tuple[Optional[str], float]]:
+        """
+        (label, posterior probability) per description, or (None, 0.0) while the model is not ready.
+        Each distinct description is scored once.
+        """
+        descriptions = list(descriptions)
+        if not self.ready():
+            return [(None, 0.0)] * len(descriptions)
+        prior, log_likelihood = self.log_probs()
+        distinct = list(dict.fromkeys(descriptions))
+        scored = {}
+        for start in range(0, len(distinct), PREDICT_BATCH):
+            batch = distinct[start:start + PREDICT_BATCH]
+            grams = [features(description) for description in batch]
+            scores = np.repeat(prior[:, None], len(batch), axis=1)
+            present = [i for i, g in enumerate(grams) if g]
+            if present:
+                flat = np.concatenate([grams[i] for i in present])
+                lengths = np.array([len(grams[i]) for i in present])
+                offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+                # Overlapping n-grams are far from independent; averaging rather than summing their
+                # evidence keeps the posteriors from saturating at 1.0, so they read as confidences
+                scores[:, present] += np.add.reduceat(log_likelihood[:, flat], offsets, axis=1) / lengths
+            posterior = np.exp(scores - scores.max(axis=0))
+            posterior /= posterior.sum(axis=0)
+            best = posterior.argmax(axis=0)
+            for i, description in enumerate(batch):
+                scored[description] = (self.classes[best[i]], float(posterior[best[i], i]))
+        return [scored[description] for description in descriptions]
+
+    def save(self, path: str):
+        meta = {"version": MODEL_VERSION, "hash_buckets": HASH_BUCKETS, "classes": self.classes,
+                "labels": self.labels, "trained_until": self.trained_until}
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez_compressed(f, counts=self.counts, docs=self.docs, meta=np.array(json.dumps(meta)))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["NaiveBayes"]:
+        """
+        The model cached at `path`, or None if there is none or it was written by another MODEL_VERSION.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != MODEL_VERSION or meta.get("hash_buckets") != HASH_BUCKETS:
+                logger.info("Discarding categorizer cached by model version %s", meta.get("version"))
+                return None
+            return cls(meta["classes"], data["counts"], data["docs"], meta["labels"], meta["trained_until"])
+
+
+_lock = threading.Lock()
+_models: Dict[str, NaiveBayes] = {}
+
+
+def model_path(cursor: sqlite3.Cursor) -> Optional[str]:
+    """
+    Where the categorizer of the cursor's database is cached: beside the database file, or
+    BUDGET_MODEL_PATH when set. None for an in-memory database.
+    """
+    if os.environ.get("BUDGET_MODEL_PATH"):
+        return os.environ["BUDGET_MODEL_PATH"]
+    database = db.database_file(cursor)
+    return f"{os.path.splitext(database)[0]}.categorizer.npz" if database else None
+
+
+def train(cursor: sqlite3.Cursor) -> NaiveBayes:
+    """
+    The categorizer with every user label folded in. Loaded from disk on first use in a process,
+    then only the labels changed since it was last trained are read, and it is saved again if any were.
+    """
+    path = model_path(cursor)
+    with _lock:
+        model = _models.get(path) if path else None
+        if model is None:
+            model = (path and NaiveBayes.load(path)) or NaiveBayes()
+        cursor.execute(LABELS_SQL, (model.trained_until,))
+        changed = model.update(cursor.fetchall())
+        if path:
+            if changed:
+                model.save(path)
+                logger.info("Categorizer trained on %d new labels (%d in total)", changed, len(model.labels))
+            _models[path] = model
+    return model
+
+
+def forget(path: Optional[str]):
+    """
+    Drops the cached model for `path`, in memory and on disk, so the next train() starts from scratch.
+    """
+    with _lock:
+        _models.pop(path, None)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train (or retrain) the categorizer from the user-assigned categories.")
+    parser.add_argument("--rebuild", action="store_true", help="Discard the cached model and train from every label.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    conn = db.get_db_connection(True)
+    cursor = conn.cursor()
+    if args.rebuild:
+        forget(model_path(cursor))
+    model = train(cursor)
+    print(f"{len(model.labels)} labels over {len(model.classes)} categories; "
+          f"{'ready' if model.ready() else f'needs {MIN_LABELS} labels in at least two categories'}")
+    conn.close()
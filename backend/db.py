@@ -0,0 +1,82 @@
+import os
+import queue
+import sqlite3
+
+import metrics
+
+DB_PATH = os.environ.get("BUDGET_DB_PATH", "/db/transactions.db")
+LOCAL_DB_PATH = os.environ.get("BUDGET_LOCAL_DB_PATH", "/Users/matthew.coudert/budget/db/transactions.db")
+POOL_SIZE = int(os.environ.get("BUDGET_DB_POOL_SIZE", "8"))
+
+# Applied once per connection; pooled connections keep their page cache and mmap between requests
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,  # negative values are KiB
+    "busy_timeout": 5000,
+}
+
+
+def connect(path: str = DB_PATH) -> sqlite3.Connection:
+    # Requests run on FastAPI's threadpool, so a pooled connection may be picked up by any thread.
+    # The pool only ever hands a connection to one request at a time.
+    conn = sqlite3.connect(path, check_same_thread=False, factory=metrics.ProfiledConnection)
+    conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def database_file(cursor: sqlite3.Cursor) -> str:
+    """
+    Path of the cursor's main database file; empty for an in-memory database.
+    """
+    cursor.execute("PRAGMA database_list")
+    return next((row[2] for row in cursor.fetchall() if row[1] == "main"), "")
+
+
+def get_db_connection(is_local: bool = False) -> sqlite3.Connection:
+    return connect(LOCAL_DB_PATH if is_local else DB_PATH)
+
+
+class ConnectionPool:
+    def __init__(self, path: str = DB_PATH, size: int = POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path)
+
+    def release(self, conn: sqlite3.Connection):
+        # Anything a handler left uncommitted is discarded rather than leaking into the next request
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+pool = ConnectionPool()
+
+
+def get_db():
+    """
+    FastAPI dependency that lends the request a pooled connection and takes it back afterwards.
+    """
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
@@ -1,15 +1,139 @@
-import amex, splitwise, monzo, views
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import List, Optional
 
+import amex, splitwise, monzo, views, bulk
+from db import database_file, get_db_connection
 
-def main():
-    try:
-        amex.main()
-    except:
-        print("Error in amex")
-    splitwise.main()
-    monzo.main()
-    views.main()
+logger = logging.getLogger(__name__)
+
+# Directory (or single file) of Amex CSV exports picked up by the full load; skipped when unset
+AMEX_IMPORT_PATH = os.environ.get("AMEX_IMPORT_PATH")
+
+
+@dataclass
+class SourceResult:
+    source: str
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    fetch_seconds: float = 0.0
+    write_seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main() -> List[SourceResult]:
+    """
+    Fetches every source concurrently and writes them one at a time through a single connection,
+    so SQLite only ever sees one writer. A failing source is reported without stopping the others.
+    The loaders maintain the transactions table as they write, so the views are only rebuilt when
+    their definitions are missing or out of date.
+    """
+    conn = get_db_connection(True)
+    path = database_file(conn.cursor())
+    updated_after = splitwise.current_watermark(conn)
+    monzo_watermark = monzo.current_watermark(conn)
+
+    # source -> (fetch, run on a worker thread; store, run on the writer connection)
+    sources = {
+        'splitwise': (lambda: list(splitwise.SplitwiseApi().iter_expenses(updated_after)),
+                      lambda expenses: splitwise.store(conn, expenses, updated_after)),
+        'monzo': (lambda: monzo.pull_data(monzo_watermark),
+                  lambda pull: monzo.store(conn, pull.records, watermark=pull.watermark)),
+    }
+    if AMEX_IMPORT_PATH:
+        sources['amex'] = (lambda: amex.csv_paths([AMEX_IMPORT_PATH]),
+                           lambda paths: amex.store(conn, paths))
+
+    results = {name: SourceResult(name) for name in sources}
+    with bulk.load_pragmas(conn), ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {executor.submit(timed, fetch): name for name, (fetch, _) in sources.items()}
+        for future in as_completed(futures):
+            result = results[futures[future]]
+            try:
+                data, result.fetch_seconds = future.result()
+                stats, result.write_seconds = timed(sources[result.source][1], data)
+                result.rows, result.inserted, result.updated, result.unchanged = stats.rows, stats.inserted, stats.updated, stats.unchanged
+            except Exception as e:
+                conn.rollback()
+                result.error = f"{type(e).__name__}: {e}"
+                logger.exception("%s load failed", result.source)
+    conn.close()
+
+    if views.main(path=path):
+        logger.info("Rebuilt the views of %s", path)
+    for result in results.values():
+        logger.info("%s: %d rows (%d inserted, %d updated, %d unchanged), fetch %.2fs, write %.2fs%s",
+                    result.source, result.rows, result.inserted, result.updated, result.unchanged,
+                    result.fetch_seconds, result.write_seconds, f", error {result.error}" if result.error else "")
+    return list(results.values())
+
+
+class FullLoadJob:
+    """
+    Runs main() in the background and keeps the outcome of the latest run for the status endpoint.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = "idle"
+        self.started_at = None
+        self.finished_at = None
+        self.sources: List[SourceResult] = []
+        self.error = None
+
+    def start(self) -> bool:
+        """
+        Marks the job as running. Returns False if a load is already in progress.
+        """
+        with self._lock:
+            if self.state == "running":
+                return False
+            self.state = "running"
+            self.started_at = datetime.now(timezone.utc).isoformat()
+            self.finished_at = None
+            self.sources = []
+            self.error = None
+            return True
+
+    def run(self):
+        try:
+            sources = main()
+            state, error = ("failed" if any(s.error for s in sources) else "succeeded"), None
+        except Exception as e:
+            sources, state, error = [], "failed", f"{type(e).__name__}: {e}"
+            logger.exception("Full load failed")
+        with self._lock:
+            self.sources = sources
+            self.state = state
+            self.error = error
+            self.finished_at = datetime.now(timezone.utc).isoformat()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "error": self.error,
+                "sources": [asdict(s) for s in self.sources],
+            }
+
+
+job = FullLoadJob()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
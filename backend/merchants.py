@@ -0,0 +1,117 @@
+import json
+import re
+import sqlite3
+from functools import lru_cache
+from typing import Iterable, Optional
+
+import sync_state
+
+# Per account: the raw table, the expression the cleaned view uses as transaction_id (indexed since
+# user lookups go through it) and the column naming the merchant. Monzo's name is its own cleaned
+# merchant name, where the view's description also carries the statement text and notes.
+MERCHANT_SOURCES = {
+    'AMEX': ('amex_raw', 'cast(reference as varchar)', 'description'),
+    'MONZO': ('monzo_raw', 'cast(transaction_id as varchar)', "coalesce(nullif(name, ''), description)"),
+    'SPLITWISE': ('splitwise_raw', 'cast(id as varchar)', 'description'),
+}
+
+TRANSACTION_MERCHANTS_TABLE = """
+CREATE TABLE IF NOT EXISTS transaction_merchants (
+    transaction_id TEXT PRIMARY KEY,
+    account TEXT,
+    merchant TEXT NOT NULL
+);
+"""
+
+TRANSACTION_MERCHANTS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_transaction_merchants_merchant ON transaction_merchants (merchant, transaction_id);",
+]
+
+MERCHANT_UPSERT = """
+    INSERT INTO transaction_merchants (transaction_id, account, merchant) VALUES (?, ?, ?)
+    ON CONFLICT(transaction_id) DO UPDATE SET
+        account=excluded.account,
+        merchant=excluded.merchant
+    WHERE merchant IS NOT excluded.merchant
+"""
+
+# Card processors that prefix the merchant's own name ("SQ *CAFE", "SUMUP *BARBER", "ZETTLE_*SHOP")
+_PROCESSOR_PREFIX = re.compile(r"^(?:sq|sumup|zettle|izettle|paypal|crv|sp|tst)\s*_?\*\s*")
+_DIGIT = re.compile(r"\d")
+# Trailing tokens that name what kind of company rather than which merchant. Place names are kept:
+# they are often part of the name ("transport for london").
+TRAILING_NOISE = {"ltd", "limited", "plc", "llp", "inc", "gbp"}
+MAX_TOKENS = 4
+# Bump when merchant_key changes; keys stored by another version are derived again
+KEY_VERSION = 2
+SYNC_SOURCE = 'merchants'
+
+
+@lru_cache(maxsize=65536)
+def merchant_key(text: Optional[str]) -> str:
+    """
+    Normalized merchant of a statement description: lower-cased, processor prefix removed, tokens
+    and '*'-separated parts containing digits (store numbers, references) dropped, trailing
+    company-type words dropped, at most MAX_TOKENS words. Only the categorizer and merchant grouping
+    use the key; the category rules match the full description. Punctuation inside a word is kept, as
+    the keyword rules match on it ('co-op', 'b&q', 'lime*').
+    """
+    text = _PROCESSOR_PREFIX.sub('', (text or '').lower().strip())
+    tokens = []
+    for token in text.split():
+        token = '*'.join(part for part in token.split('*') if not _DIGIT.search(part)).strip("*.,;:'\"()/#-")
+        if token:
+            tokens.append(token)
+    while len(tokens) > 1 and tokens[-1] in TRAILING_NOISE:
+        tokens.pop()
+    return ' '.join(tokens[:MAX_TOKENS]) or text
+
+
+def _table_exists(cursor: sqlite3.Cursor, name: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def create_table(cursor: sqlite3.Cursor):
+    """
+    Creates transaction_merchants and its index, deriving every merchant already loaded the first
+    time and again whenever KEY_VERSION has moved on.
+    """
+    cursor.execute(TRANSACTION_MERCHANTS_TABLE)
+    for index in TRANSACTION_MERCHANTS_INDEXES:
+        cursor.execute(index)
+    sync_state.create_table(cursor)
+    if (sync_state.load_watermark(cursor, SYNC_SOURCE) or {}).get('key_version') != KEY_VERSION:
+        rebuild(cursor)
+        sync_state.save_watermark(cursor, SYNC_SOURCE, {'key_version': KEY_VERSION})
+
+
+def refresh(cursor: sqlite3.Cursor, account: str, keys: Optional[Iterable] = None) -> int:
+    """
+    Derives the merchant of one account's transactions for the given raw primary keys, typically the
+    changed_keys of an import, or for every transaction of the account when keys is None.
+    Returns the number of rows written.
+    """
+    table, transaction_id, merchant = MERCHANT_SOURCES[account]
+    if keys is None:
+        cursor.execute(f"SELECT {transaction_id}, {merchant} FROM {table}")
+    else:
+        keys = json.dumps([str(key) for key in keys])
+        if keys == '[]':
+            return 0
+        cursor.execute(f"""
+            SELECT {transaction_id}, {merchant} FROM {table}
+            WHERE {transaction_id} IN (SELECT value FROM json_each(?))
+        """, (keys,))
+    rows = [(key, account, merchant_key(text)) for key, text in cursor.fetchall()]
+    cursor.executemany(MERCHANT_UPSERT, rows)
+    return len(rows)
+
+
+def rebuild(cursor: sqlite3.Cursor):
+    """
+    Derives the merchant of every transaction of every account that has been loaded.
+    """
+    for account, (table, _, _) in MERCHANT_SOURCES.items():
+        if _table_exists(cursor, table):
+            refresh(cursor, account)
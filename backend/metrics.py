@@ -0,0 +1,221 @@
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged at WARNING with their row count
+SLOW_QUERY_SECONDS = float(os.environ.get("BUDGET_SLOW_QUERY_MS", "100")) / 1000
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Prometheus-style histogram: a count per upper bound, plus the running sum and count.
+    """
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry:
+    """
+    Process-wide request and SQL metrics, rendered in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str], Histogram] = {}
+        self.statements: Dict[str, Histogram] = {}
+        self.statement_rows: Dict[str, int] = {}
+        self.slow_statements = 0
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        with self._lock:
+            self.requests.setdefault((method, route, str(status)), Histogram()).observe(seconds)
+
+    def observe_statement(self, sql: str, seconds: float, rows: int):
+        statement = normalize_sql(sql)
+        with self._lock:
+            self.statements.setdefault(statement, Histogram()).observe(seconds)
+            self.statement_rows[statement] = self.statement_rows.get(statement, 0) + max(rows, 0)
+            if seconds >= SLOW_QUERY_SECONDS:
+                self.slow_statements += 1
+        if seconds >= SLOW_QUERY_SECONDS:
+            logger.warning("slow query: %.1f ms, %d rows: %s", seconds * 1000, rows, statement)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines += _histogram_lines("budget_http_request_duration_seconds", "Request latency by route.",
+                                      {(("method", m), ("route", r), ("status", s)): h for (m, r, s), h in self.requests.items()})
+            lines += _histogram_lines("budget_sql_statement_duration_seconds", "Execution plus fetch time per SQL statement.",
+                                      {(("statement", s),): h for s, h in self.statements.items()})
+            lines += ["# HELP budget_sql_rows_total Rows returned (or changed) per SQL statement.",
+                      "# TYPE budget_sql_rows_total counter"]
+            lines += [f"budget_sql_rows_total{_labels((('statement', s),))} {rows}" for s, rows in self.statement_rows.items()]
+            lines += [f"# HELP budget_sql_slow_statements_total Statements slower than {SLOW_QUERY_SECONDS * 1000:g} ms.",
+                      "# TYPE budget_sql_slow_statements_total counter",
+                      f"budget_sql_slow_statements_total {self.slow_statements}"]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs) -> str:
+    escaped = (f'{name}="{value.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+               for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _histogram_lines(name: str, help_text: str, histograms: dict):
+    yield f"# HELP {name} {help_text}"
+    yield f"# TYPE {name} histogram"
+    for labels, histogram in histograms.items():
+        for bound, count in histogram.cumulative():
+            yield f"{name}_bucket{_labels((*labels, ('le', bound)))} {count}"
+        yield f"{name}_sum{_labels(labels)} {histogram.sum:.6f}"
+        yield f"{name}_count{_labels(labels)} {histogram.count}"
+
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str, limit: int = 240) -> str:
+    return _WHITESPACE.sub(" ", sql).strip()[:limit]
+
+
+registry = Registry()
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Times each statement from execute until its result is exhausted (or the cursor moves on) and
+    counts the rows it returned; the total is reported to `registry` once per statement.
+    """
+    _statement = None  # [sql, seconds, rows] of the statement whose rows are still being read
+
+    def _finish(self):
+        if self._statement is not None:
+            registry.observe_statement(*self._statement)
+            self._statement = None
+
+    def _time(self, seconds: float, rows: int = 0, done: bool = False):
+        if self._statement is not None:
+            self._statement[1] += seconds
+            self._statement[2] += rows
+            if done:
+                self._finish()
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._statement = [sql, time.perf_counter() - start, 0]
+        if self.description is None:  # no result set: DDL or a write
+            self._statement[2] = self.rowcount
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        registry.observe_statement(sql, time.perf_counter() - start, self.rowcount)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._time(time.perf_counter() - start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._time(time.perf_counter() - start, len(rows), len(rows) < (self.arraysize if size is None else size))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._time(time.perf_counter() - start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._time(time.perf_counter() - start, done=True)
+            raise
+        self._time(time.perf_counter() - start, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, including the implicit ones of execute/executemany, are ProfiledCursors.
+    """
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class MetricsMiddleware:
+    """
+    Observes the latency of every request under its route template. Responses that never reach the
+    router (cache hits) fall back to their path; unrouted 404s share one label. Plain ASGI rather
+    than BaseHTTPMiddleware, so it adds next to nothing to each request.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", None)
+            if route is None:
+                route = "<unmatched>" if status == 404 else scope["path"]
+            registry.observe_request(scope["method"], route, status, time.perf_counter() - start)
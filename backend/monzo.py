@@ -1,12 +1,62 @@
+import logging
+import sys
+from dataclasses import dataclass
+from typing import List, Optional
+
 import gspread
+from gspread.utils import numericise_all, rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 
-from app import get_db_connection
+import bulk
+import merchants
+import sync_state
+import views
+from db import get_db_connection
+
+logger = logging.getLogger(__name__)
 
 SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 SPREADSHEET_KEY = "1M46p-BUbQdGPRDg-vFFqmc4YXzxM4KHVV_zrZT2zarY"
+# Sheet headers in the order of MonzoRawTransaction.to_row
+SHEET_COLUMNS = ['Transaction ID', 'Date', 'Time', 'Type', 'Name', 'Emoji', 'Category', 'Amount', 'Currency',
+                 'Local amount', 'Local currency', 'Notes and #tags', 'Address', 'Receipt', 'Description',
+                 'Category split']
+# Sheet dates are DD/MM/YYYY; timestamps are kept at day precision, as the cleaned view has always reported them
+DATE_FORMAT = "%d/%m/%Y"
+SYNC_SOURCE = 'monzo'
+# Already-ingested rows re-read on each incremental sync, so recent edits (notes, categories) still land
+OVERLAP_ROWS = 20
 
 class MonzoRawTransaction:
+    TABLE = "monzo_raw"
+    KEY = "transaction_id"
+    KEY_INDEX = 0
+    UPSERT_SQL = """
+        INSERT INTO monzo_raw (transaction_id, date, time, trans_type, name, emoji, category, amount, currency, local_amount, local_currency, notes_and_tags, address, receipt, description, category_split, timestamp, month, content_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(transaction_id) DO UPDATE SET
+            date=excluded.date,
+            time=excluded.time,
+            trans_type=excluded.trans_type,
+            name=excluded.name,
+            emoji=excluded.emoji,
+            category=excluded.category,
+            amount=excluded.amount,
+            currency=excluded.currency,
+            local_amount=excluded.local_amount,
+            local_currency=excluded.local_currency,
+            notes_and_tags=excluded.notes_and_tags,
+            address=excluded.address,
+            receipt=excluded.receipt,
+            description=excluded.description,
+            category_split=excluded.category_split,
+            timestamp=excluded.timestamp,
+            month=excluded.month,
+            content_hash=excluded.content_hash,
+            ingestion_timestamp=CURRENT_TIMESTAMP
+        WHERE content_hash IS NOT excluded.content_hash
+        """
+
     def __init__(self, transaction_id, date, time, trans_type, name, emoji, category, amount, currency,
                  local_amount, local_currency, notes_and_tags, address, receipt, description, category_split):
         self.transaction_id = transaction_id
@@ -49,32 +99,41 @@ class MonzoRawTransaction:
             receipt TEXT,
             description TEXT,
             category_split TEXT,
+            timestamp INTEGER,  -- epoch seconds of date, parsed on load
+            month TEXT,  -- YYYY-MM of date
+            content_hash TEXT,
             ingestion_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        bulk.ensure_column(cursor, "monzo_raw", "content_hash", "TEXT")
+        if bulk.ensure_column(cursor, "monzo_raw", "timestamp", "INTEGER"):
+            bulk.ensure_column(cursor, "monzo_raw", "month", "TEXT")
+            # One-off backfill of rows loaded before the keys were stored
+            cursor.execute("""
+                UPDATE monzo_raw SET
+                    timestamp = cast(strftime('%s', substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)) AS integer),
+                    month = substr(date, 7, 4) || '-' || substr(date, 4, 2)
+            """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_monzo_raw_timestamp ON monzo_raw (timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_monzo_raw_month ON monzo_raw (month)")
+        # Same expression as transaction_id in the cleaned view, so refresh_transactions' lookups by id are indexed
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_monzo_raw_transaction_id ON monzo_raw (cast(transaction_id as varchar))")
+
+    def to_row(self):
+        return (self.transaction_id, self.date, self.time, self.trans_type, self.name, self.emoji, self.category, self.amount, self.currency, self.local_amount, self.local_currency, self.notes_and_tags, self.address, self.receipt, self.description, self.category_split,
+                *bulk.parse_date_keys([self.date], DATE_FORMAT)[0])
+
+    @staticmethod
+    def rows_from_spreadsheet(records):
+        """
+        Column-oriented equivalent of from_spreadsheet(row).to_row() for every sheet record.
+        """
+        columns = [[record[header] for record in records] for header in SHEET_COLUMNS]
+        date_keys = bulk.parse_date_keys(columns[1], DATE_FORMAT)
+        return zip(*columns, [key[0] for key in date_keys], [key[1] for key in date_keys])
 
     def insert(self, cursor):
-        cursor.execute("""
-            INSERT INTO monzo_raw (transaction_id, date, time, trans_type, name, emoji, category, amount, currency, local_amount, local_currency, notes_and_tags, address, receipt, description, category_split)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(transaction_id) DO UPDATE SET
-                date=excluded.date,
-                time=excluded.time,
-                trans_type=excluded.trans_type,
-                name=excluded.name,
-                emoji=excluded.emoji,
-                category=excluded.category,
-                amount=excluded.amount,
-                currency=excluded.currency,
-                local_amount=excluded.local_amount,
-                local_currency=excluded.local_currency,
-                notes_and_tags=excluded.notes_and_tags,
-                address=excluded.address,
-                receipt=excluded.receipt,
-                description=excluded.description,
-                category_split=excluded.category_split,
-                ingestion_timestamp=CURRENT_TIMESTAMP
-            """, (self.transaction_id, self.date, self.time, self.trans_type, self.name, self.emoji, self.category, self.amount, self.currency, self.local_amount, self.local_currency, self.notes_and_tags, self.address, self.receipt, self.description, self.category_split))
+        cursor.execute(self.UPSERT_SQL, bulk.with_hash(self.to_row()))
 
     @classmethod
     def from_spreadsheet(cls, row):
@@ -99,28 +158,114 @@ class MonzoRawTransaction:
     
 
 
-def pull_data():
+@dataclass
+class SheetPull:
+    records: List[dict]
+    watermark: Optional[dict]  # header, rows and last_transaction_id of the sheet as read; None if it has no rows
+    full: bool
+
+
+def open_worksheet():
     creds = ServiceAccountCredentials.from_json_keyfile_name("gsheet_creds.json", SCOPE)
     client = gspread.authorize(creds)
     sheet = client.open_by_key(SPREADSHEET_KEY)
-    worksheet = sheet.get_worksheet(1)
-    return worksheet.get_all_records()
+    return sheet.get_worksheet(1)
 
 
-def main():
-    data = pull_data()
-    conn = get_db_connection(True)
+def sheet_watermark(header: List[str], rows: int, records: List[dict]) -> Optional[dict]:
+    if not records:
+        return None
+    return {'header': header, 'rows': rows, 'last_transaction_id': str(records[-1]['Transaction ID'])}
+
+
+def to_records(header: List[str], rows: List[list]) -> List[dict]:
+    """
+    Sheet rows as get_all_records() would return them: padded to the header and numericised.
+    """
+    return [dict(zip(header, numericise_all(row + [''] * (len(header) - len(row))))) for row in rows]
+
+
+def full_pull(worksheet) -> SheetPull:
+    records = worksheet.get_all_records()
+    header = list(records[0]) if records else []
+    return SheetPull(records, sheet_watermark(header, len(records), records), True)
+
+
+def pull_data(watermark: Optional[dict] = None, worksheet=None) -> SheetPull:
+    """
+    Reads the rows appended since `watermark`, plus the last OVERLAP_ROWS before it, with one ranged
+    request. Falls back to the whole sheet when there is no watermark or the sheet no longer lines up
+    with it: a changed header, or a different transaction at the watermark row (rows removed or reordered).
+    """
+    worksheet = worksheet or open_worksheet()
+    if not watermark:
+        return full_pull(worksheet)
+
+    header, rows = watermark['header'], watermark['rows']
+    first = max(1, rows - OVERLAP_ROWS + 1)  # first data row to read; the sheet row is one lower, below the header
+    last_column = rowcol_to_a1(1, len(header))[:-1]
+    header_row, tail = worksheet.batch_get(['1:1', f'A{first + 1}:{last_column}'])
+    watermark_row = rows - first  # index in tail of the last row already ingested
+    id_column = header.index('Transaction ID')
+    if (list(header_row[0] if header_row else []) != header or len(tail) <= watermark_row
+            or tail[watermark_row][id_column] != watermark['last_transaction_id']):
+        logger.info("Monzo sheet no longer matches its watermark (%d rows, last %s); resyncing all of it",
+                    rows, watermark['last_transaction_id'])
+        return full_pull(worksheet)
+
+    records = to_records(header, list(tail))
+    return SheetPull(records, sheet_watermark(header, first - 1 + len(records), records), False)
+
+
+def current_watermark(conn) -> Optional[dict]:
+    """
+    Where the last sync stopped reading the sheet, or None before the first sync.
+    """
+    cursor = conn.cursor()
+    sync_state.create_table(cursor)
+    return sync_state.load_watermark(cursor, SYNC_SOURCE)
+
+
+def store(conn, records, batch_size: int = bulk.DEFAULT_BATCH_SIZE, watermark: Optional[dict] = None) -> bulk.UpsertStats:
+    """
+    Upserts sheet records into monzo_raw, saves the sheet watermark they were read up to (if given)
+    and commits both together.
+    """
     cursor = conn.cursor()
 
     MonzoRawTransaction.create_table(cursor)
+    merchants.create_table(cursor)
+    sync_state.create_table(cursor)
 
-    for row in data:
-        trans = MonzoRawTransaction.from_spreadsheet(row)
-        trans.insert(cursor)
+    stats = bulk.bulk_upsert(cursor, MonzoRawTransaction, MonzoRawTransaction.rows_from_spreadsheet(records), batch_size)
 
+    views.refresh_transactions(cursor, 'MONZO', stats.changed_keys)
+    merchants.refresh(cursor, 'MONZO', stats.changed_keys)
+    if watermark:
+        sync_state.save_watermark(cursor, SYNC_SOURCE, watermark)
+    if stats.changed_keys:
+        sync_state.bump_data_version(cursor)
     conn.commit()
+    return stats
+
+
+def sync(conn, worksheet=None, batch_size: int = bulk.DEFAULT_BATCH_SIZE, full: bool = False) -> bulk.UpsertStats:
+    """
+    Upserts the sheet rows added since the last sync, or the whole sheet when `full` or the sheet
+    does not match the stored watermark.
+    """
+    watermark = None if full else current_watermark(conn)
+    pull = pull_data(watermark, worksheet)
+    return store(conn, pull.records, batch_size, pull.watermark)
+
+
+def main(batch_size: int = bulk.DEFAULT_BATCH_SIZE, full: bool = False):
+    conn = get_db_connection(True)
+    with bulk.load_pragmas(conn):
+        stats = sync(conn, batch_size=batch_size, full=full)
     conn.close()
+    print(f"Monzo: {stats.inserted} inserted, {stats.updated} updated, {stats.unchanged} unchanged")
 
 
 if __name__ == "__main__":
-    main()
+    main(full='--full' in sys.argv)
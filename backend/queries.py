@@ -0,0 +1,42 @@
+from functools import lru_cache
+
+import sqlglot
+
+# Request-path queries are built with sqlglot once per shape (which optional filters are present) and
+# cached as parameterized SQL. Callers bind values by name, so user input never reaches the SQL text and
+# repeated calls reuse SQLite's prepared statement for that exact string.
+
+
+@lru_cache(maxsize=None)
+def transactions_query(uncategorized_only: bool, by_month: bool) -> str:
+    """
+    SQL for categories.pull_transactions. Binds :history_start, plus :start and :end when `by_month`.
+    """
+    query = (
+        sqlglot.select(
+            "transaction_id",
+            "strftime('%Y-%m-%d', timestamp, 'unixepoch') AS date",
+            "description",
+            "amount",
+            "account",
+            "category"
+        )
+        .from_("transactions_with_category")
+        .where("timestamp >= :history_start")
+    )
+    if uncategorized_only:
+        query = query.where("category IS NULL")
+    if by_month:
+        query = query.where("timestamp >= :start AND timestamp < :end")
+    return query.order_by("timestamp DESC").sql("sqlite")
+
+
+@lru_cache(maxsize=None)
+def total_query(by_category: bool) -> str:
+    """
+    SQL for the /total endpoint. Binds :category when `by_category`.
+    """
+    query = sqlglot.select("sum(amount) AS total").from_("transactions_with_category")
+    if by_category:
+        query = query.where("category = :category")
+    return query.sql("sqlite")
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.requests import Request
+from starlette.responses import Response
+
+MAX_ENTRIES = int(os.environ.get("BUDGET_RESPONSE_CACHE_SIZE", 256))
+
+
+class ResponseCache:
+    """
+    LRU cache of response bodies, valid for one data version. Writes move the version on in the
+    database (sync_state.bump_data_version); once observe() sees a new version every entry is dropped
+    at once, and the version is part of every ETag.
+    """
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = None
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[str, bytes, str]]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Tuple[str, bytes, str]]:
+        """
+        (etag, body, media type) for `key`, marking it most recently used; None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: Hashable, body: bytes, media_type: str, version: int) -> str:
+        """
+        Stores a body computed while the data was at `version` and returns its ETag. A body computed
+        at a version that has since moved on is not stored, so a write racing a read never leaves a
+        stale entry behind.
+        """
+        etag = f'"{version}-{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        with self._lock:
+            if version == self.version:
+                self._entries[key] = (etag, body, media_type)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return etag
+
+    def observe(self, version: int):
+        """
+        Records the current data version, dropping every entry computed at another one.
+        """
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = ResponseCache()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+class ResponseCacheMiddleware(BaseHTTPMiddleware):
+    """
+    Serves GETs of `paths` from `cache`, keyed by path and query parameters, and answers
+    If-None-Match with 304 when the client already holds the current body. `version` reads the
+    current data version; it is called once per cached request, off the event loop.
+    """
+    def __init__(self, app, paths, version: Callable[[], int], response_cache: ResponseCache = cache):
+        super().__init__(app)
+        self.paths = frozenset(paths)
+        self.version = version
+        self.cache = response_cache
+
+    async def dispatch(self, request: Request, call_next):
+        if request.method != "GET" or request.url.path not in self.paths:
+            return await call_next(request)
+
+        key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+        if_none_match = request.headers.get("if-none-match")
+        version = await run_in_threadpool(self.version)
+        self.cache.observe(version)
+        entry = self.cache.get(key)
+        if entry is not None:
+            etag, body, media_type = entry
+            return self._respond(etag, body, media_type, if_none_match, "HIT")
+
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        media_type = response.headers.get("content-type", "application/json")
+        etag = self.cache.put(key, body, media_type, version)
+        return self._respond(etag, body, media_type, if_none_match, "MISS")
+
+    @staticmethod
+    def _respond(etag: str, body: bytes, media_type: str, if_none_match: Optional[str], status: str) -> Response:
+        # no-cache: browsers keep the body but revalidate with If-None-Match on every use
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Cache": status}
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,237 @@
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import db
+
+DEFAULT_PRIORITY = 100
+
+RULES_TABLE = """
+CREATE TABLE IF NOT EXISTS category_rules (
+    id INTEGER PRIMARY KEY,
+    pattern TEXT NOT NULL,  -- found anywhere in the description, lower-cased with spaces removed
+    category TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 100,  -- the lowest matching priority wins, then the lowest id
+    account TEXT,  -- AMEX, MONZO or SPLITWISE; NULL for every account
+    min_amount REAL,  -- bounds on the amount as the views sign it (spending is negative); NULL for none
+    max_amount REAL,
+    update_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# A single counter moved by every write to category_rules, however it is made, so a process only
+# recompiles its matcher after the rules actually change
+RULES_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS category_rules_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+"""
+
+RULES_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS category_rules_after_{event.lower()} AFTER {event} ON category_rules
+    BEGIN
+        UPDATE category_rules_version SET version = version + 1 WHERE id = 1;
+    END;
+    """
+    for event in ("INSERT", "UPDATE", "DELETE")
+]
+
+RULE_COLUMNS = "id, pattern, category, priority, account, min_amount, max_amount"
+
+
+@dataclass(frozen=True)
+class Rule:
+    id: int
+    pattern: str
+    category: str
+    priority: int = DEFAULT_PRIORITY
+    account: Optional[str] = None
+    min_amount: Optional[float] = None
+    max_amount: Optional[float] = None
+
+    def applies(self, account: Optional[str], amount: Optional[float]) -> bool:
+        return ((self.account is None or self.account == account)
+                and (self.min_amount is None or (amount is not None and amount >= self.min_amount))
+                and (self.max_amount is None or (amount is not None and amount <= self.max_amount)))
+
+
+def clean_text(text: Optional[str]) -> str:
+    return (text or '').lower().replace(' ', '')
+
+
+def trie_pattern(keywords: Iterable[str]) -> str:
+    """
+    Builds a regex that matches the longest keyword starting at a position, with alternatives
+    factored by common prefix so the engine branches on one character at a time.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+
+    return build(trie)
+
+
+def _order(rule: Rule) -> Tuple[int, int]:
+    return rule.priority, rule.id
+
+
+class RuleMatcher:
+    """
+    Every rule pattern compiled into one trie regex. The rules whose pattern occurs in a text are
+    found once per distinct text; the account and amount filters are then checked per transaction.
+    """
+    CACHE_LIMIT = 100000
+
+    def __init__(self, rules: Iterable[Rule], version: int = 0):
+        self.rules = sorted(rules, key=_order)
+        self.version = version
+        by_pattern: Dict[str, List[Rule]] = {}
+        for rule in self.rules:
+            by_pattern.setdefault(rule.pattern, []).append(rule)
+        # The regex matches the longest pattern at a position, so that match also stands for every
+        # pattern that is a prefix of it
+        self._rules_for_match = {
+            pattern: sorted((rule for other, rules in by_pattern.items() if pattern.startswith(other) for rule in rules), key=_order)
+            for pattern in by_pattern
+        }
+        self._pattern = re.compile(trie_pattern(by_pattern)) if by_pattern else None
+        self._candidates: Dict[str, List[Rule]] = {}
+
+    def candidates(self, text: Optional[str]) -> List[Rule]:
+        """
+        Rules whose pattern occurs in the text, best first. Searching again from one past each match
+        start also finds patterns that overlap it.
+        """
+        cleaned = clean_text(text)
+        found = self._candidates.get(cleaned)
+        if found is None:
+            matched = {}
+            match = self._pattern.search(cleaned) if self._pattern else None
+            while match:
+                matched.update(dict.fromkeys(self._rules_for_match[match.group()]))
+                match = self._pattern.search(cleaned, match.start() + 1)
+            found = sorted(matched, key=_order)
+            if len(self._candidates) >= self.CACHE_LIMIT:
+                self._candidates.clear()
+            self._candidates[cleaned] = found
+        return found
+
+    def match(self, text: Optional[str], account: Optional[str] = None, amount: Optional[float] = None) -> Optional[Rule]:
+        return next((rule for rule in self.candidates(text) if rule.applies(account, amount)), None)
+
+
+def seed_rules(keyword_groups: Iterable[Tuple[str, Iterable[str]]]) -> List[Rule]:
+    """
+    Rules for (category, keywords) groups in priority order, numbered from 1.
+    """
+    rules = []
+    for priority, (category, keywords) in enumerate(keyword_groups):
+        for keyword in keywords:
+            rules.append(Rule(len(rules) + 1, keyword, getattr(category, 'value', category), priority))
+    return rules
+
+
+def create_table(cursor: sqlite3.Cursor, seed: Iterable[Rule] = ()):
+    """
+    Creates category_rules and its version counter, inserting the `seed` rules the first time.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'category_rules'")
+    created = cursor.fetchone() is None
+    cursor.execute(RULES_TABLE)
+    cursor.execute(RULES_VERSION_TABLE)
+    cursor.execute("INSERT OR IGNORE INTO category_rules_version (id, version) VALUES (1, 0)")
+    for trigger in RULES_VERSION_TRIGGERS:
+        cursor.execute(trigger)
+    if created:
+        cursor.executemany(f"INSERT INTO category_rules ({RULE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(r.id, r.pattern, r.category, r.priority, r.account, r.min_amount, r.max_amount) for r in seed])
+
+
+def rules_version(cursor: sqlite3.Cursor) -> int:
+    cursor.execute("SELECT version FROM category_rules_version WHERE id = 1")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def load_rules(cursor: sqlite3.Cursor) -> List[Rule]:
+    cursor.execute(f"SELECT {RULE_COLUMNS} FROM category_rules ORDER BY priority, id")
+    return [Rule(*row) for row in cursor.fetchall()]
+
+
+def clean_account(account: Optional[str]) -> Optional[str]:
+    """
+    Accounts are stored, and matched, upper-cased as the views name them.
+    """
+    return account.upper() if account else None
+
+
+def get_rule(cursor: sqlite3.Cursor, rule_id: int) -> Optional[Rule]:
+    cursor.execute(f"SELECT {RULE_COLUMNS} FROM category_rules WHERE id = ?", (rule_id,))
+    row = cursor.fetchone()
+    return Rule(*row) if row else None
+
+
+def add_rule(cursor: sqlite3.Cursor, pattern: str, category: str, priority: int = DEFAULT_PRIORITY,
+             account: Optional[str] = None, min_amount: Optional[float] = None, max_amount: Optional[float] = None) -> Rule:
+    cursor.execute("""
+        INSERT INTO category_rules (pattern, category, priority, account, min_amount, max_amount)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (clean_text(pattern), category, priority, clean_account(account), min_amount, max_amount))
+    return get_rule(cursor, cursor.lastrowid)
+
+
+def update_rule(cursor: sqlite3.Cursor, rule: Rule) -> Optional[Rule]:
+    """
+    Replaces the stored rule with the same id. Returns the rule it replaced, or None if there was none.
+    """
+    previous = get_rule(cursor, rule.id)
+    if previous is not None:
+        cursor.execute("""
+            UPDATE category_rules
+            SET pattern = ?, category = ?, priority = ?, account = ?, min_amount = ?, max_amount = ?,
+                update_timestamp = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (clean_text(rule.pattern), rule.category, rule.priority, clean_account(rule.account), rule.min_amount, rule.max_amount, rule.id))
+    return previous
+
+
+def delete_rule(cursor: sqlite3.Cursor, rule_id: int) -> Optional[Rule]:
+    """
+    Deletes a rule. Returns it, or None if there was none.
+    """
+    previous = get_rule(cursor, rule_id)
+    if previous is not None:
+        cursor.execute("DELETE FROM category_rules WHERE id = ?", (rule_id,))
+    return previous
+
+
+_lock = threading.Lock()
+_matchers: Dict[str, RuleMatcher] = {}
+
+
+def matcher(cursor: sqlite3.Cursor) -> RuleMatcher:
+    """
+    The compiled rules of the cursor's database. Costs one version lookup per call; the rules are only
+    read and compiled again after the version has moved, whichever process or connection changed them.
+    """
+    version = rules_version(cursor)
+    database = db.database_file(cursor)
+    with _lock:
+        current = _matchers.get(database)
+        if current is None or current.version != version:
+            current = _matchers[database] = RuleMatcher(load_rules(cursor), version)
+    return current
@@ -2,14 +2,55 @@ import sqlite3
 import requests
 import os
 import json
-from typing import Optional, List
+import sys
+from datetime import datetime
+from typing import Iterable, Optional, List
 
-from app import get_db_connection
+import bulk
+import merchants
+import sync_state
+import views
+from db import get_db_connection
 
 BASE_URL = "https://secure.splitwise.com/api/v3.0/"
+PAGE_SIZE = 500
+SYNC_SOURCE = 'splitwise'
+# The Splitwise user whose net balance on each expense becomes the transaction amount
+OWNER_USER_ID = int(os.environ.get('SPLITWISE_USER_ID', '51056312'))
+
+# One row per person on an expense, broken out of the users JSON as expenses are stored so that
+# reads join on (expense_id, user_id) instead of parsing every expense's JSON again
+SPLITWISE_SHARES_TABLE = """
+CREATE TABLE IF NOT EXISTS splitwise_shares (
+    expense_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    paid_share REAL,
+    owed_share REAL,
+    net_balance REAL,
+    PRIMARY KEY (expense_id, user_id)
+) WITHOUT ROWID;
+"""
+
+SPLITWISE_SHARES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_splitwise_shares_user ON splitwise_shares (user_id, expense_id);",
+]
+
+# The shares are cast as the cleaned view used to cast net_balance, so amounts stay as they were
+SPLITWISE_SHARES_FROM_USERS = """
+    INSERT OR REPLACE INTO splitwise_shares (expense_id, user_id, paid_share, owed_share, net_balance)
+    SELECT
+        splitwise_raw.id,
+        json_extract(value, '$.user_id'),
+        cast(json_extract(value, '$.paid_share') as float),
+        cast(json_extract(value, '$.owed_share') as float),
+        cast(json_extract(value, '$.net_balance') as float)
+    FROM splitwise_raw, json_each(splitwise_raw.users)
+    WHERE json_extract(value, '$.user_id') IS NOT NULL
+"""
 
 class SplitwiseApi():
-    def __init__(self):
+    def __init__(self, base_url: str = os.environ.get('SPLITWISE_BASE_URL', BASE_URL)):
+        self.base_url = base_url
         self.api_key = os.environ['SPLITWISE_API_KEY']
         self.consumer_key = os.environ['SPLITWISE_CONSUMER_KEY']
         self.consumer_secret = os.environ['SPLITWISE_CONSUMER_SECRET']
@@ -19,17 +60,91 @@ class SplitwiseApi():
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
         }
-        response = requests.post(BASE_URL + method, headers=headers, params=params)
+        response = requests.post(self.base_url + method, headers=headers, params=params)
         return response.json()
 
-    def get_expenses(self, limit: int = 50, offset: int = 0):
-        return self.make_request('get_expenses', {
+    def get_expenses(self, limit: int = 50, offset: int = 0, updated_after: Optional[str] = None):
+        params = {
             'limit': limit,
             'offset': offset
-        })
+        }
+        if updated_after:
+            params['updated_after'] = updated_after
+        return self.make_request('get_expenses', params)
+
+    def iter_expenses(self, updated_after: Optional[str] = None, page_size: int = PAGE_SIZE):
+        """
+        Yields every expense updated after `updated_after` (all of them when None), one page at a time.
+        """
+        offset = 0
+        while True:
+            page = self.get_expenses(page_size, offset, updated_after)['expenses']
+            yield from page
+            if len(page) < page_size:
+                return
+            offset += page_size
+
+
+def parse_date(date: Optional[str]) -> Optional[datetime]:
+    """
+    Parses an ISO 8601 expense date such as 2024-01-05T12:00:00Z; None if missing or malformed.
+    """
+    try:
+        return datetime.fromisoformat(date)
+    except (TypeError, ValueError):
+        return None
 
 
 class SplitwiseRawTransaction:
+    TABLE = "splitwise_raw"
+    KEY = "id"
+    KEY_INDEX = 0
+    UPSERT_SQL = """
+        INSERT INTO splitwise_raw (
+            id, group_id, expense_bundle_id, description, repeats, repeat_interval, 
+            email_reminder, email_reminder_in_advance, next_repeat, details, 
+            comments_count, payment, creation_method, transaction_method, transaction_confirmed, 
+            transaction_id, transaction_status, cost, currency_code, date, created_at, 
+            updated_at, deleted_at, created_by, updated_by, deleted_by, category, receipt, 
+            repayments, users, timestamp, month, content_hash, ingestion_timestamp
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(id) DO UPDATE SET
+        group_id = excluded.group_id,
+        expense_bundle_id = excluded.expense_bundle_id,
+        description = excluded.description,
+        repeats = excluded.repeats,
+        repeat_interval = excluded.repeat_interval,
+        email_reminder = excluded.email_reminder,
+        email_reminder_in_advance = excluded.email_reminder_in_advance,
+        next_repeat = excluded.next_repeat,
+        details = excluded.details,
+        comments_count = excluded.comments_count,
+        payment = excluded.payment,
+        creation_method = excluded.creation_method,
+        transaction_method = excluded.transaction_method,
+        transaction_confirmed = excluded.transaction_confirmed,
+        transaction_id = excluded.transaction_id,
+        transaction_status = excluded.transaction_status,
+        cost = excluded.cost,
+        currency_code = excluded.currency_code,
+        date = excluded.date,
+        created_at = excluded.created_at,
+        updated_at = excluded.updated_at,
+        deleted_at = excluded.deleted_at,
+        created_by = excluded.created_by,
+        updated_by = excluded.updated_by,
+        deleted_by = excluded.deleted_by,
+        category = excluded.category,
+        receipt = excluded.receipt,
+        repayments = excluded.repayments,
+        users = excluded.users,
+        timestamp = excluded.timestamp,
+        month = excluded.month,
+        content_hash = excluded.content_hash,
+        ingestion_timestamp=CURRENT_TIMESTAMP
+        WHERE content_hash IS NOT excluded.content_hash
+    """
+
     def __init__(self,
                  id: int,
                  group_id: Optional[int],
@@ -130,51 +245,8 @@ class SplitwiseRawTransaction:
             users=data.get("users", [])  # Users list
         )
 
-    def insert_into_db(self, cursor: sqlite3.Cursor):
-        """
-        Insert the SplitwiseRawTransaction data into an SQLite database.
-        """
-        cursor.execute("""
-            INSERT INTO splitwise_raw (
-                id, group_id, expense_bundle_id, description, repeats, repeat_interval, 
-                email_reminder, email_reminder_in_advance, next_repeat, details, 
-                comments_count, payment, creation_method, transaction_method, transaction_confirmed, 
-                transaction_id, transaction_status, cost, currency_code, date, created_at, 
-                updated_at, deleted_at, created_by, updated_by, deleted_by, category, receipt, 
-                repayments, users, ingestion_timestamp
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(id) DO UPDATE SET
-            group_id = excluded.group_id,
-            expense_bundle_id = excluded.expense_bundle_id,
-            description = excluded.description,
-            repeats = excluded.repeats,
-            repeat_interval = excluded.repeat_interval,
-            email_reminder = excluded.email_reminder,
-            email_reminder_in_advance = excluded.email_reminder_in_advance,
-            next_repeat = excluded.next_repeat,
-            details = excluded.details,
-            comments_count = excluded.comments_count,
-            payment = excluded.payment,
-            creation_method = excluded.creation_method,
-            transaction_method = excluded.transaction_method,
-            transaction_confirmed = excluded.transaction_confirmed,
-            transaction_id = excluded.transaction_id,
-            transaction_status = excluded.transaction_status,
-            cost = excluded.cost,
-            currency_code = excluded.currency_code,
-            date = excluded.date,
-            created_at = excluded.created_at,
-            updated_at = excluded.updated_at,
-            deleted_at = excluded.deleted_at,
-            created_by = excluded.created_by,
-            updated_by = excluded.updated_by,
-            deleted_by = excluded.deleted_by,
-            category = excluded.category,
-            receipt = excluded.receipt,
-            repayments = excluded.repayments,
-            users = excluded.users,
-            ingestion_timestamp=CURRENT_TIMESTAMP
-        """, (
+    def to_row(self) -> tuple:
+        return (
             self.id, self.group_id, self.expense_bundle_id, self.description, self.repeats,
             self.repeat_interval, self.email_reminder, self.email_reminder_in_advance,
             self.next_repeat, self.details, self.comments_count, self.payment,
@@ -184,8 +256,23 @@ class SplitwiseRawTransaction:
             self.created_by, self.updated_by, self.deleted_by,
             self.category, self.receipt,
             json.dumps(self.repayments),
-            json.dumps(self.users)
-        ))
+            json.dumps(self.users),
+            *bulk.date_keys(parse_date(self.date))
+        )
+
+    @classmethod
+    def rows_from_api(cls, expenses: List[dict]):
+        return (cls.from_api(expense).to_row() for expense in expenses)
+
+    def insert_into_db(self, cursor: sqlite3.Cursor):
+        """
+        Insert the SplitwiseRawTransaction data into an SQLite database, with its shares and derived rows.
+        """
+        cursor.execute(self.UPSERT_SQL, bulk.with_hash(self.to_row()))
+        refresh_shares(cursor, [self.id])
+        views.refresh_transactions(cursor, 'SPLITWISE', [self.id])
+        merchants.refresh(cursor, 'SPLITWISE', [self.id])
+        sync_state.bump_data_version(cursor)
 
     @staticmethod
     def create_table(cursor: sqlite3.Cursor):
@@ -224,25 +311,114 @@ class SplitwiseRawTransaction:
                 receipt TEXT,
                 repayments TEXT,
                 users TEXT,
+                timestamp INTEGER,  -- epoch seconds of date, parsed on load
+                month TEXT,  -- YYYY-MM of date
+                content_hash TEXT,
                 ingestion_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        bulk.ensure_column(cursor, "splitwise_raw", "content_hash", "TEXT")
+        if bulk.ensure_column(cursor, "splitwise_raw", "timestamp", "INTEGER"):
+            bulk.ensure_column(cursor, "splitwise_raw", "month", "TEXT")
+            # One-off backfill of rows loaded before the keys were stored
+            cursor.execute("""
+                UPDATE splitwise_raw SET
+                    timestamp = cast(strftime('%s', date) AS integer),
+                    month = strftime('%Y-%m', date)
+            """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_splitwise_raw_timestamp ON splitwise_raw (timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_splitwise_raw_month ON splitwise_raw (month)")
+        # Same expression as transaction_id in the cleaned view, so refresh_transactions' lookups by id are indexed
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_splitwise_raw_transaction_id ON splitwise_raw (cast(id as varchar))")
+        created = not views.table_exists(cursor, 'splitwise_shares')
+        cursor.execute(SPLITWISE_SHARES_TABLE)
+        for index in SPLITWISE_SHARES_INDEXES:
+            cursor.execute(index)
+        if created:
+            refresh_shares(cursor)
 
 
+def refresh_shares(cursor: sqlite3.Cursor, keys: Optional[Iterable[int]] = None) -> int:
+    """
+    Rewrites the splitwise_shares of the given expense ids, typically the changed_keys of an import,
+    or of every expense when keys is None. Returns the number of shares written.
+    """
+    if keys is None:
+        cursor.execute("DELETE FROM splitwise_shares")
+        cursor.execute(SPLITWISE_SHARES_FROM_USERS)
+        return cursor.rowcount
+    keys = json.dumps(list(keys))
+    if keys == '[]':
+        return 0
+    cursor.execute("DELETE FROM splitwise_shares WHERE expense_id IN (SELECT value FROM json_each(?))", (keys,))
+    cursor.execute(SPLITWISE_SHARES_FROM_USERS + " AND splitwise_raw.id IN (SELECT value FROM json_each(?))", (keys,))
+    return cursor.rowcount
 
-def main():
-    splitwise = SplitwiseApi()
-    expenses = splitwise.get_expenses(2000)
-    conn = get_db_connection(True)
+
+
+def current_watermark(conn) -> Optional[str]:
+    """
+    The updated_at of the newest expense already stored, or None before the first sync.
+    """
     cursor = conn.cursor()
+    sync_state.create_table(cursor)
+    watermark = sync_state.load_watermark(cursor, SYNC_SOURCE) or {}
+    return watermark.get('updated_after')
+
 
+def store(conn, expenses: Iterable[dict], updated_after: Optional[str], batch_size: int = bulk.DEFAULT_BATCH_SIZE) -> bulk.UpsertStats:
+    """
+    Upserts expenses fetched with `updated_after`, advances the watermark to the newest updated_at
+    seen and commits.
+    """
+    cursor = conn.cursor()
     SplitwiseRawTransaction.create_table(cursor)
+    merchants.create_table(cursor)
+    sync_state.create_table(cursor)
+
+    high_water = updated_after
+    def track_updates():
+        nonlocal high_water
+        for expense in expenses:
+            updated_at = expense.get('updated_at') or expense.get('created_at')
+            if updated_at and (high_water is None or updated_at > high_water):
+                high_water = updated_at
+            yield expense
 
-    [SplitwiseRawTransaction.from_api(expense).insert_into_db(cursor) for expense in expenses['expenses']]
+    stats = bulk.bulk_upsert(cursor, SplitwiseRawTransaction, SplitwiseRawTransaction.rows_from_api(track_updates()), batch_size)
+
+    # The cleaned view takes amounts from the shares, so they are written before the transactions refresh
+    refresh_shares(cursor, stats.changed_keys)
+    views.refresh_transactions(cursor, 'SPLITWISE', stats.changed_keys)
+    merchants.refresh(cursor, 'SPLITWISE', stats.changed_keys)
+    if high_water:
+        sync_state.save_watermark(cursor, SYNC_SOURCE, {'updated_after': high_water})
+    if stats.changed_keys:
+        sync_state.bump_data_version(cursor)
     conn.commit()
+    return stats
 
 
-if __name__ == '__main__':
-    main()
+def sync(conn, api: SplitwiseApi, batch_size: int = bulk.DEFAULT_BATCH_SIZE, full: bool = False) -> bulk.UpsertStats:
+    """
+    Upserts the expenses updated since the last sync. Deleted expenses come back with deleted_at set,
+    which drops them from the cleaned view.
+    """
+    if full:
+        cursor = conn.cursor()
+        sync_state.create_table(cursor)
+        sync_state.clear_watermark(cursor, SYNC_SOURCE)
+    updated_after = current_watermark(conn)
+    return store(conn, api.iter_expenses(updated_after), updated_after, batch_size)
 
 
+def main(batch_size: int = bulk.DEFAULT_BATCH_SIZE, full: bool = False):
+    conn = get_db_connection(True)
+    with bulk.load_pragmas(conn):
+        stats = sync(conn, SplitwiseApi(), batch_size, full)
+    conn.close()
+    print(f"Splitwise: {stats.inserted} inserted, {stats.updated} updated, {stats.unchanged} unchanged")
+
+
+if __name__ == '__main__':
+    main(full='--full' in sys.argv)
@@ -0,0 +1,64 @@
+import json
+import sqlite3
+from typing import Optional
+
+
+# A single counter moved by every write that can change what the API returns, from whichever
+# process made it, so each server process can tell when its cached responses went stale
+DATA_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL
+);
+"""
+
+
+def create_table(cursor: sqlite3.Cursor):
+    """
+    Creates the sync_state table, holding one JSON watermark per incremental source, and the data version.
+    """
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS sync_state (
+        source TEXT PRIMARY KEY,
+        watermark TEXT,
+        update_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cursor.execute(DATA_VERSION_TABLE)
+
+
+def load_watermark(cursor: sqlite3.Cursor, source: str) -> Optional[dict]:
+    cursor.execute("SELECT watermark FROM sync_state WHERE source = ?", (source,))
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_watermark(cursor: sqlite3.Cursor, source: str, watermark: dict):
+    cursor.execute('''
+        INSERT INTO sync_state (source, watermark) VALUES (?, ?)
+        ON CONFLICT(source) DO UPDATE SET
+                watermark=excluded.watermark,
+                update_timestamp=CURRENT_TIMESTAMP
+        ''', (source, json.dumps(watermark)))
+
+
+def clear_watermark(cursor: sqlite3.Cursor, source: str):
+    cursor.execute("DELETE FROM sync_state WHERE source = ?", (source,))
+
+
+def data_version(cursor: sqlite3.Cursor) -> int:
+    cursor.execute("SELECT version FROM data_version WHERE id = 1")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump_data_version(cursor: sqlite3.Cursor):
+    """
+    Moves the data version on, invalidating every cached response once the write is committed.
+    Call it in the same transaction as the write.
+    """
+    cursor.execute(DATA_VERSION_TABLE)
+    cursor.execute("""
+        INSERT INTO data_version (id, version) VALUES (1, 1)
+        ON CONFLICT(id) DO UPDATE SET version = version + 1
+    """)
@@ -0,0 +1,259 @@
+import csv
+import json
+import os
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator, List
+from urllib.parse import parse_qs, urlparse
+
+from gspread.utils import a1_range_to_grid_range, numericise_all, to_records
+
+import amex
+import monzo
+import splitwise
+
+START = datetime(2022, 6, 1, tzinfo=timezone.utc)
+DAYS = 3 * 365
+
+# (statement description, amex category, monzo category, min amount, max amount); descriptions get a
+# store number half the time so there are many distinct strings per merchant, as on real statements
+MERCHANTS = [
+    ("TESCO STORES", "General Purchases-Groceries", "groceries", 3, 90),
+    ("SAINSBURYS S/MKTS", "General Purchases-Groceries", "groceries", 3, 90),
+    ("WAITROSE", "General Purchases-Groceries", "groceries", 5, 120),
+    ("LIDL GB", "General Purchases-Groceries", "groceries", 3, 60),
+    ("PRET A MANGER", "Entertainment-Restaurants", "eating_out", 3, 15),
+    ("GAIL'S BAKERY", "Entertainment-Restaurants", "eating_out", 3, 20),
+    ("DISHOOM", "Entertainment-Restaurants", "eating_out", 25, 90),
+    ("TFL TRAVEL CH", "Travel-Other Travel", "transport", 1.5, 12),
+    ("LIME*RIDE", "Travel-Other Travel", "transport", 1, 8),
+    ("TRAINLINE", "Travel-Rail Services", "transport", 10, 150),
+    ("AVANTI WEST COAST", "Travel-Rail Services", "transport", 20, 180),
+    ("AMAZON.CO.UK", "General Purchases-Online Purchases", "shopping", 5, 200),
+    ("AMZNMKTPLACE", "General Purchases-Online Purchases", "shopping", 5, 120),
+    ("WATERSTONES", "General Purchases-Books", "shopping", 8, 40),
+    ("DUNELM", "General Purchases-Home", "shopping", 10, 250),
+    ("THAMES WATER", "Business Services-Utilities", "bills", 30, 60),
+    ("VODAFONE LTD", "Business Services-Telecoms", "bills", 15, 45),
+    ("VIRGIN MEDIA", "Business Services-Telecoms", "bills", 30, 65),
+    ("BARBER SHOP", "General Purchases-Personal Care", "personal_care", 15, 35),
+    ("GYMPASS", "General Purchases-Sports", "personal_care", 30, 70),
+    ("NETFLIX.COM", "Entertainment-Other", "entertainment", 5, 18),
+    ("DELIVEROO", "Entertainment-Restaurants", "eating_out", 12, 45),
+    ("CORNER SHOP", "General Purchases-Other", "general", 1, 25),
+    ("SOHO CAFE", "Entertainment-Restaurants", "eating_out", 3, 14),
+]
+TOWNS = [("LONDON", "N1 9GU"), ("LONDON", "E8 3PH"), ("MANCHESTER", "M1 1AE"), ("EDINBURGH", "EH1 1YZ")]
+
+
+@dataclass
+class Split:
+    amex: int
+    monzo: int
+    splitwise: int
+
+
+def split(transactions: int) -> Split:
+    """
+    How a total transaction count is shared between the sources: mostly cards, a tenth shared expenses.
+    """
+    splitwise = transactions // 10
+    amex_count = (transactions - splitwise) // 2
+    return Split(amex_count, transactions - splitwise - amex_count, splitwise)
+
+
+def _moment(rng: random.Random) -> datetime:
+    return START + timedelta(days=rng.randrange(DAYS), seconds=rng.randrange(7 * 3600, 23 * 3600))
+
+
+def _merchant(rng: random.Random):
+    name, amex_category, monzo_category, low, high = rng.choice(MERCHANTS)
+    if rng.random() < 0.5:
+        name = f"{name} {rng.randrange(1000, 9999)}"
+    return name, amex_category, monzo_category, round(rng.uniform(low, high), 2)
+
+
+def amex_rows(count: int, seed: int = 0) -> Iterator[list]:
+    """
+    Amex statement CSV rows in CSV_COLUMNS order; a few percent are refunds.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        name, category, _, amount = _merchant(rng)
+        town, postcode = rng.choice(TOWNS)
+        yield [
+            _moment(rng).strftime("%d/%m/%Y"), name, -amount if rng.random() < 0.03 else amount,
+            f"{name} {town}", name, "1 HIGH STREET", town, postcode, "UNITED KINGDOM",
+            f"AT{seed:03d}{i:012d}", category,
+        ]
+
+
+def write_amex_csvs(directory: str, count: int, seed: int = 0, rows_per_file: int = 50000) -> List[str]:
+    """
+    Writes `count` Amex rows as statement exports of at most rows_per_file rows and returns their paths.
+    """
+    paths, rows = [], amex_rows(count, seed)
+    for part in range(max(1, -(-count // rows_per_file))):
+        path = os.path.join(directory, f"amex_{seed}_{part:03d}.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(amex.CSV_COLUMNS)
+            for _ in range(min(rows_per_file, count - part * rows_per_file)):
+                writer.writerow(next(rows))
+        paths.append(path)
+    return paths
+
+
+def monzo_records(count: int, seed: int = 0) -> Iterator[dict]:
+    """
+    Records shaped like the Monzo export sheet's get_all_records(); card spend plus the odd top-up.
+    """
+    rng = random.Random(seed + 1)
+    for i in range(count):
+        name, _, category, amount = _merchant(rng)
+        moment = _moment(rng)
+        top_up = rng.random() < 0.02
+        record = {header: "" for header in monzo.SHEET_COLUMNS}
+        record.update({
+            "Transaction ID": f"tx_{seed:03d}{i:016x}",
+            "Date": moment.strftime("%d/%m/%Y"),
+            "Time": moment.strftime("%H:%M:%S"),
+            "Type": "Pot transfer" if top_up else "Card payment",
+            "Name": "Holiday Pot" if top_up else name.title(),
+            "Category": "transfers" if top_up else category,
+            "Amount": amount if top_up else -amount,
+            "Currency": "GBP",
+            "Local amount": amount if top_up else -amount,
+            "Local currency": "GBP",
+            "Address": "" if top_up else f"1 High Street, {rng.choice(TOWNS)[0].title()}",
+            "Description": "HOLIDAYPOT" if top_up else name,
+        })
+        yield record
+
+
+class LocalWorksheet:
+    """
+    In-memory stand-in for the gspread worksheet monzo.pull_data reads. Values are kept as the
+    formatted strings the Sheets API returns, trailing blank cells are trimmed from each row it hands
+    back, and cells_read counts every cell transferred.
+    """
+    def __init__(self, header: List[str], rows: Iterable[list] = ()):
+        self.values = [list(header)]
+        self.cells_read = 0
+        self.append_rows(rows)
+
+    def append_rows(self, rows: Iterable[list]):
+        self.values += [["" if value is None else str(value) for value in row] for row in rows]
+
+    def _read(self, rows: List[list]) -> List[list]:
+        rows = [row[:max((i + 1 for i, value in enumerate(row) if value != ""), default=0)] for row in rows]
+        self.cells_read += sum(map(len, rows))
+        return rows
+
+    def get_all_records(self) -> List[dict]:
+        header, *rows = self._read(self.values)
+        return to_records(header, [numericise_all(row + [""] * (len(header) - len(row))) for row in rows])
+
+    def batch_get(self, ranges: Iterable[str]) -> List[List[list]]:
+        results = []
+        for name in ranges:
+            grid = a1_range_to_grid_range(name)
+            rows = self.values[grid.get("startRowIndex", 0):grid.get("endRowIndex")]
+            results.append(self._read([row[grid.get("startColumnIndex", 0):grid.get("endColumnIndex")] for row in rows]))
+        return results
+
+
+def monzo_sheet_rows(records: Iterable[dict]) -> Iterator[list]:
+    """
+    monzo_records as sheet rows in SHEET_COLUMNS order, for LocalWorksheet.
+    """
+    for record in records:
+        yield [record[header] for header in monzo.SHEET_COLUMNS]
+
+
+def splitwise_expenses(count: int, seed: int = 0, owner: int = splitwise.OWNER_USER_ID) -> List[dict]:
+    """
+    Expenses shaped like get_expenses results, each split with one other person; about 2% are deleted.
+    """
+    rng = random.Random(seed + 2)
+    expenses = []
+    for i in range(count):
+        name, _, _, cost = _merchant(rng)
+        moment = _moment(rng)
+        owner_paid = rng.random() < 0.5
+        paid, owed = (cost, round(cost / 2, 2)) if owner_paid else (0.0, round(cost / 2, 2))
+        updated = moment + timedelta(hours=rng.randrange(1, 72))
+        expenses.append({
+            "id": seed * 10_000_000 + i,
+            "group_id": rng.choice([None, 101, 102]),
+            "description": name.title(),
+            "payment": False,
+            "cost": f"{cost:.2f}",
+            "currency_code": "GBP",
+            "date": moment.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "created_at": moment.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "updated_at": updated.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "deleted_at": updated.strftime("%Y-%m-%dT%H:%M:%SZ") if rng.random() < 0.02 else None,
+            "repayments": [],
+            "users": [
+                {"user_id": owner, "paid_share": f"{paid:.2f}", "owed_share": f"{owed:.2f}", "net_balance": f"{paid - owed:.2f}"},
+                {"user_id": 1000 + rng.randrange(5), "paid_share": f"{cost - paid:.2f}", "owed_share": f"{cost - owed:.2f}",
+                 "net_balance": f"{(cost - paid) - (cost - owed):.2f}"},
+            ],
+        })
+    return expenses
+
+
+class FakeSplitwiseServer:
+    """
+    Local HTTP stand-in for the Splitwise get_expenses endpoint, for syncing offline. Serves
+    `expenses` with the API's updated_after filter and limit/offset paging, and records the query
+    parameters of every request. Use as a context manager; base_url is what SplitwiseApi takes.
+    """
+    def __init__(self, expenses: Iterable[dict] = ()):
+        self.expenses = list(expenses)
+        self.requests: List[dict] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                server.requests.append(params)
+                if url.path != "/get_expenses":
+                    self.send_error(404)
+                    return
+                body = json.dumps({"expenses": server.page(**params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def page(self, limit: str = "20", offset: str = "0", updated_after: str = None) -> List[dict]:
+        # Oldest change first, so a page boundary never moves while the sync pages through it
+        matching = sorted((e for e in self.expenses if updated_after is None or e["updated_at"] > updated_after),
+                          key=lambda e: (e["updated_at"], e["id"]))
+        return matching[int(offset):int(offset) + int(limit)]
+
+    def __enter__(self) -> "FakeSplitwiseServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,48 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+# The backend modules import each other as top-level modules, as when run from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import views
+
+
+@pytest.fixture
+def db_path(tmp_path) -> str:
+    """
+    A fresh database with every raw table and the materialized transactions table.
+    """
+    path = str(tmp_path / "transactions.db")
+    views.main(True, path)
+    return path
+
+
+@pytest.fixture
+def conn(db_path):
+    conn = db.connect(db_path)
+    yield conn
+    conn.close()
+
+
+def rows(conn: sqlite3.Connection, sql: str, *params) -> list:
+    return [tuple(row) for row in conn.execute(sql, params).fetchall()]
+
+
+@pytest.fixture
+def client(conn, db_path, monkeypatch):
+    """
+    A test client whose requests all use `conn`; the response cache reads the data version through
+    a pool on the same database.
+    """
+    from fastapi.testclient import TestClient
+
+    import app
+    monkeypatch.setattr(db, "pool", db.ConnectionPool(db_path))
+    app.app.dependency_overrides[db.get_db] = lambda: conn
+    with TestClient(app.app) as client:
+        yield client
+    app.app.dependency_overrides.clear()
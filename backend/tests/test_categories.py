@@ -0,0 +1,47 @@
+import pytest
+
+import categories
+import merchants
+import monzo
+import synthetic
+
+
+def monzo_record(index: int, name: str, description: str = "", notes: str = "") -> dict:
+    record = next(synthetic.monzo_records(1))
+    record.update({"Transaction ID": f"tx_test_{index}", "Date": "05/03/2024", "Name": name,
+                   "Description": description, "Notes and #tags": notes, "Category": ""})
+    return record
+
+
+def categories_by_id(conn) -> dict:
+    return dict(conn.execute("SELECT transaction_id, category FROM transactions").fetchall())
+
+
+@pytest.mark.parametrize("name, description, notes, expected", [
+    ("TRANSPORT FOR LONDON", "", "", "TRANSPORT"),  # keyword spans the place name the merchant key used to drop
+    ("LIME*2 RIDES", "", "", "TRANSPORT"),  # keyword keeps the '*' the key splits on
+    ("Transport Ldn", "TFL TRAVEL CH", "", "TRANSPORT"),  # keyword only in the statement description
+    ("Corner Shop", "CORNER SHOP", "christmas pot", "GIFTS"),  # keyword only in the notes
+    ("Big Local Shop Down The Road Tesco", "", "", "GROCERIES"),  # keyword past MAX_TOKENS words
+])
+def test_rules_match_the_full_description(conn, name, description, notes, expected):
+    monzo.store(conn, [monzo_record(0, name, description, notes)])
+
+    categories.run_model_batch(conn.cursor())
+
+    assert categories_by_id(conn) == {"tx_test_0": expected}
+
+
+def test_merchant_key_keeps_place_names():
+    assert merchants.merchant_key("TRANSPORT FOR LONDON") == "transport for london"
+    assert merchants.merchant_key("SQ *TESCO STORES 2331 LTD") == "tesco stores"
+
+
+def test_changed_key_version_rederives_stored_merchants(conn, monkeypatch):
+    monzo.store(conn, [monzo_record(0, "TRANSPORT FOR LONDON")])
+    conn.execute("UPDATE transaction_merchants SET merchant = 'transport for'")
+    monkeypatch.setattr(merchants, "KEY_VERSION", merchants.KEY_VERSION + 1)
+
+    merchants.create_table(conn.cursor())
+
+    assert conn.execute("SELECT merchant FROM transaction_merchants").fetchall()[0][0] == "transport for london"
@@ -0,0 +1,34 @@
+import functools
+
+import db
+import full_load
+import monzo
+import splitwise
+import synthetic
+import views
+from conftest import rows
+
+
+def test_full_load_writes_and_keeps_the_local_database_materialized(db_path, monkeypatch):
+    for name in ("SPLITWISE_API_KEY", "SPLITWISE_CONSUMER_KEY", "SPLITWISE_CONSUMER_SECRET"):
+        monkeypatch.setenv(name, "test")
+    monkeypatch.setattr(db, "LOCAL_DB_PATH", db_path)
+    monkeypatch.setattr(full_load, "AMEX_IMPORT_PATH", None)
+    records = list(synthetic.monzo_records(40))
+    worksheet = synthetic.LocalWorksheet(monzo.SHEET_COLUMNS, synthetic.monzo_sheet_rows(records))
+    monkeypatch.setattr(monzo, "open_worksheet", lambda: worksheet)
+    rebuilds = []
+    main = views.main
+    monkeypatch.setattr(views, "main", lambda *args, **kwargs: rebuilds.append(main(*args, **kwargs)) or rebuilds[-1])
+
+    with synthetic.FakeSplitwiseServer(synthetic.splitwise_expenses(30)) as server:
+        monkeypatch.setattr(splitwise, "SplitwiseApi", functools.partial(splitwise.SplitwiseApi, server.base_url))
+        results = full_load.main()
+
+    assert [r.error for r in results] == [None, None]
+    assert rebuilds == [False]
+    conn = db.connect(db_path)
+    live_expenses = sum(e["deleted_at"] is None for e in server.expenses)
+    assert rows(conn, "SELECT account, count(*) FROM transactions GROUP BY account") == [("MONZO", 40), ("SPLITWISE", live_expenses)]
+    assert rows(conn, "SELECT sum(count) FROM monthly_rollup") == [(40 + live_expenses,)]
+    conn.close()
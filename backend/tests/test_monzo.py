@@ -0,0 +1,112 @@
+import pytest
+
+import monzo
+import sync_state
+import synthetic
+from conftest import rows
+
+ID_COLUMN = monzo.SHEET_COLUMNS.index("Transaction ID")
+
+
+@pytest.fixture
+def records():
+    return list(synthetic.monzo_records(120))
+
+
+@pytest.fixture
+def worksheet(records):
+    return synthetic.LocalWorksheet(monzo.SHEET_COLUMNS, synthetic.monzo_sheet_rows(records[:100]))
+
+
+def saved_watermark(conn) -> dict:
+    return sync_state.load_watermark(conn.cursor(), monzo.SYNC_SOURCE)
+
+
+def last_id(worksheet) -> str:
+    return worksheet.values[-1][ID_COLUMN]
+
+
+def test_first_sync_reads_the_whole_sheet(conn, worksheet):
+    stats = monzo.sync(conn, worksheet)
+
+    assert stats.inserted == 100
+    assert saved_watermark(conn) == {"header": monzo.SHEET_COLUMNS, "rows": 100, "last_transaction_id": last_id(worksheet)}
+
+
+def test_appended_rows_are_read_with_the_overlap(conn, worksheet, records):
+    monzo.sync(conn, worksheet)
+    worksheet.append_rows(synthetic.monzo_sheet_rows(records[100:]))
+    worksheet.cells_read = 0
+
+    pull = monzo.pull_data(monzo.current_watermark(conn), worksheet)
+
+    assert not pull.full
+    assert [r["Transaction ID"] for r in pull.records] == [r["Transaction ID"] for r in records[100 - monzo.OVERLAP_ROWS:]]
+    assert pull.watermark == {"header": monzo.SHEET_COLUMNS, "rows": 120, "last_transaction_id": last_id(worksheet)}
+    assert worksheet.cells_read < 120 * len(monzo.SHEET_COLUMNS) / 2
+
+    stats = monzo.sync(conn, worksheet)
+    assert (stats.inserted, stats.unchanged) == (20, monzo.OVERLAP_ROWS)
+    assert saved_watermark(conn)["rows"] == 120
+    assert rows(conn, "SELECT count(*) FROM monzo_raw") == [(120,)]
+
+
+def test_overlap_picks_up_edits_to_recent_rows(conn, worksheet):
+    monzo.sync(conn, worksheet)
+    edited = worksheet.values[100 - monzo.OVERLAP_ROWS + 1]
+    edited[monzo.SHEET_COLUMNS.index("Notes and #tags")] = "edited after the last sync"
+
+    stats = monzo.sync(conn, worksheet)
+
+    assert (stats.inserted, stats.updated) == (0, 1)
+    assert rows(conn, "SELECT notes_and_tags FROM monzo_raw WHERE transaction_id = ?", edited[ID_COLUMN]) == [("edited after the last sync",)]
+
+
+def test_short_sheet_falls_back_to_a_full_pull(conn, worksheet):
+    monzo.sync(conn, worksheet)
+    del worksheet.values[-5:]
+
+    pull = monzo.pull_data(monzo.current_watermark(conn), worksheet)
+
+    assert pull.full
+    assert pull.watermark["rows"] == 95
+    assert pull.watermark["last_transaction_id"] == last_id(worksheet)
+
+
+@pytest.mark.parametrize("change", ["removed", "reordered"])
+def test_rows_moved_before_the_watermark_fall_back_to_a_full_pull(conn, worksheet, change):
+    monzo.sync(conn, worksheet)
+    if change == "removed":
+        del worksheet.values[10]
+    else:
+        worksheet.values[1], worksheet.values[-1] = worksheet.values[-1], worksheet.values[1]
+
+    pull = monzo.pull_data(monzo.current_watermark(conn), worksheet)
+    assert pull.full
+
+    stats = monzo.sync(conn, worksheet)
+    assert stats.rows == len(worksheet.values) - 1
+    assert saved_watermark(conn) == {"header": monzo.SHEET_COLUMNS, "rows": len(worksheet.values) - 1,
+                                     "last_transaction_id": last_id(worksheet)}
+
+
+def test_changed_header_falls_back_to_a_full_pull(conn, worksheet, records):
+    monzo.sync(conn, worksheet)
+    worksheet.values[0].append("Extra")
+    worksheet.append_rows(row + ["x"] for row in synthetic.monzo_sheet_rows(records[100:101]))
+
+    pull = monzo.pull_data(monzo.current_watermark(conn), worksheet)
+    assert pull.full
+
+    stats = monzo.sync(conn, worksheet)
+    assert (stats.inserted, stats.unchanged) == (1, 100)
+    assert saved_watermark(conn) == {"header": monzo.SHEET_COLUMNS + ["Extra"], "rows": 101, "last_transaction_id": last_id(worksheet)}
+
+
+def test_full_sync_ignores_the_watermark(conn, worksheet):
+    monzo.sync(conn, worksheet)
+
+    stats = monzo.sync(conn, worksheet, full=True)
+
+    assert (stats.rows, stats.unchanged) == (100, 100)
+    assert saved_watermark(conn)["rows"] == 100
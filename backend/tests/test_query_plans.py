@@ -0,0 +1,9 @@
+import check_query_plans
+import db
+
+
+def test_hot_paths_never_fully_scan_large_tables(monkeypatch):
+    # check() points the pool at its own temporary database; put the original back afterwards
+    monkeypatch.setattr(db, "pool", db.pool)
+
+    assert check_query_plans.check() == []
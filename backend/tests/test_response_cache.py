@@ -0,0 +1,58 @@
+import db
+import monzo
+import synthetic
+
+
+def test_import_from_another_connection_invalidates_cached_aggregates(conn, client, db_path):
+    records = list(synthetic.monzo_records(60))
+    monzo.store(conn, records[:30])
+    first = client.get("/total")
+    assert first.headers["x-cache"] == "MISS"
+    assert client.get("/total").headers["x-cache"] == "HIT"
+    assert client.get("/total", headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    # As the loader CLIs do: their own connection, in what may be another process
+    loader = db.connect(db_path)
+    monzo.store(loader, records)
+    loader.close()
+
+    second = client.get("/total", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 200
+    assert second.headers["x-cache"] == "MISS"
+    assert second.headers["etag"] != first.headers["etag"]
+    assert second.json()["total"] != first.json()["total"]
+
+
+def test_unchanged_import_keeps_cached_aggregates(conn, client):
+    records = list(synthetic.monzo_records(20))
+    monzo.store(conn, records)
+    client.get("/pivot_data")
+
+    monzo.store(conn, records)
+
+    assert client.get("/pivot_data").headers["x-cache"] == "HIT"
+
+
+def test_categorize_invalidates_cached_aggregates(conn, client):
+    monzo.store(conn, list(synthetic.monzo_records(20)))
+    transaction_id = conn.execute("SELECT transaction_id FROM transactions LIMIT 1").fetchone()[0]
+    client.get("/pivot_data")
+
+    assert client.put("/categorize/", json={"transaction_id": transaction_id, "user_category": "GIFTS"}).status_code == 200
+
+    assert client.get("/pivot_data").headers["x-cache"] == "MISS"
+
+
+def test_cached_responses_carry_cors_headers(conn, client):
+    monzo.store(conn, list(synthetic.monzo_records(20)))
+    origin = {"Origin": "http://localhost:3000"}
+
+    for path in ("/total", "/pivot_data", "/category_spend?category=GROCERIES"):
+        miss = client.get(path, headers=origin)
+        hit = client.get(path, headers=origin)
+        revalidated = client.get(path, headers={**origin, "If-None-Match": hit.headers["etag"]})
+
+        assert [r.headers["x-cache"] for r in (miss, hit)] == ["MISS", "HIT"]
+        assert revalidated.status_code == 304
+        for response in (miss, hit, revalidated):
+            assert response.headers["access-control-allow-origin"] == "http://localhost:3000"
@@ -0,0 +1,47 @@
+import categories
+import monzo
+from conftest import rows
+from test_categories import categories_by_id, monzo_record
+
+
+def test_rule_change_keeps_propagated_and_user_categories(conn, client):
+    # Same merchant (TESCO STORES) at several branches, plus a Tesco Express the user never touched
+    monzo.store(conn, [monzo_record(i, f"TESCO STORES {1000 + i}") for i in range(5)]
+                + [monzo_record(9, "TESCO EXPRESS")])
+    assert client.put("/auto_categorize/").status_code == 200
+    assert set(categories_by_id(conn).values()) == {"GROCERIES"}
+
+    response = client.put("/categorize/", json={"transaction_id": "tx_test_0", "user_category": "GIFTS",
+                                                "propagate_to_merchant": True})
+    assert response.json()["propagated"] == 4
+
+    response = client.post("/rules/", json={"pattern": "tesco", "category": "SHOPPING", "priority": 0})
+    assert response.status_code == 201
+    assert response.json()["changed"] == 1
+
+    assert categories_by_id(conn) == {**{f"tx_test_{i}": "GIFTS" for i in range(5)}, "tx_test_9": "SHOPPING"}
+    assert conn.execute("SELECT count(*) FROM categories WHERE propagated_from = 'tx_test_0'").fetchone()[0] == 4
+
+    # Deleting the rule restores the rule-derived category only
+    rule_id = response.json()["rule"]["id"]
+    assert client.delete(f"/rules/{rule_id}").json()["changed"] == 1
+    assert categories_by_id(conn) == {**{f"tx_test_{i}": "GIFTS" for i in range(5)}, "tx_test_9": "GROCERIES"}
+
+
+def test_existing_full_confidence_categories_stay_reevaluable(conn):
+    # A database from before propagated_from, holding a rule-derived category at full confidence
+    conn.execute("ALTER TABLE categories DROP COLUMN propagated_from")
+    conn.execute("INSERT INTO categories (transaction_id, model_category, model_confidence) VALUES ('tx_rule', 'GROCERIES', 1.0)")
+    categories.create_table(conn.cursor())
+    assert rows(conn, "SELECT transaction_id, propagated_from FROM categories") == [("tx_rule", None)]
+
+
+def test_rule_account_is_case_insensitive(conn, client):
+    monzo.store(conn, [monzo_record(0, "TESCO STORES 1000")])
+    response = client.post("/rules/", json={"pattern": "tesco", "category": "SHOPPING", "priority": 0, "account": "monzo"})
+    assert response.status_code == 201
+    assert response.json()["rule"]["account"] == "MONZO"
+    assert categories_by_id(conn) == {"tx_test_0": "SHOPPING"}
+
+    response = client.post("/rules/", json={"pattern": "tesco", "category": "SHOPPING", "account": "barclays"})
+    assert response.status_code == 422
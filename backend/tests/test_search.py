@@ -0,0 +1,17 @@
+import pytest
+
+import monzo
+import views
+from test_categories import monzo_record
+
+
+@pytest.mark.parametrize("materialize", [True, False])
+def test_search_in_both_modes(conn, client, db_path, materialize):
+    views.main(materialize, db_path)
+    monzo.store(conn, [monzo_record(0, "TESCO STORES"), monzo_record(1, "PRET A MANGER")])
+
+    response = client.get("/search", params={"q": "tes sto"})
+
+    assert response.status_code == 200
+    assert [t["transaction_id"] for t in response.json()] == ["tx_test_0"]
+    assert client.get("/search", params={"q": "tesco pret"}).json() == []
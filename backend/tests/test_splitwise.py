@@ -0,0 +1,84 @@
+import pytest
+
+import splitwise
+import sync_state
+import synthetic
+from conftest import rows
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ("SPLITWISE_API_KEY", "SPLITWISE_CONSUMER_KEY", "SPLITWISE_CONSUMER_SECRET"):
+        monkeypatch.setenv(name, "test")
+    with synthetic.FakeSplitwiseServer() as server:
+        yield server
+
+
+def sync(conn, server, full=False):
+    return splitwise.sync(conn, splitwise.SplitwiseApi(server.base_url), full=full)
+
+
+def test_sync_pages_past_page_size(conn, server):
+    server.expenses = synthetic.splitwise_expenses(2 * splitwise.PAGE_SIZE + 7)
+
+    stats = sync(conn, server)
+
+    assert stats.inserted == len(server.expenses)
+    assert [int(r["offset"]) for r in server.requests] == [0, splitwise.PAGE_SIZE, 2 * splitwise.PAGE_SIZE]
+    assert rows(conn, "SELECT count(*) FROM splitwise_raw") == [(len(server.expenses),)]
+
+
+def test_sync_advances_updated_after_watermark(conn, server):
+    server.expenses = synthetic.splitwise_expenses(50)
+    sync(conn, server)
+    newest = max(e["updated_at"] for e in server.expenses)
+    assert splitwise.current_watermark(conn) == newest
+
+    server.requests.clear()
+    assert sync(conn, server).rows == 0
+    assert server.requests[0]["updated_after"] == newest
+
+    edited = server.expenses[3]
+    edited.update(description="Edited", updated_at="2030-01-01T00:00:00Z")
+    stats = sync(conn, server)
+
+    assert (stats.rows, stats.updated, stats.changed_keys) == (1, 1, [edited["id"]])
+    assert splitwise.current_watermark(conn) == "2030-01-01T00:00:00Z"
+    assert rows(conn, "SELECT description FROM transactions WHERE transaction_id = ?", str(edited["id"])) == [("Edited",)]
+
+
+def test_full_sync_ignores_watermark(conn, server):
+    server.expenses = synthetic.splitwise_expenses(20)
+    sync(conn, server)
+    server.requests.clear()
+
+    stats = sync(conn, server, full=True)
+
+    assert "updated_after" not in server.requests[0]
+    assert (stats.rows, stats.unchanged) == (20, 20)
+
+
+def test_deleted_expense_drops_out_of_transactions(conn, server):
+    server.expenses = [e for e in synthetic.splitwise_expenses(30) if e["deleted_at"] is None]
+    sync(conn, server)
+    deleted = server.expenses[0]
+    transaction_id = str(deleted["id"])
+    assert rows(conn, "SELECT count(*) FROM transactions WHERE transaction_id = ?", transaction_id) == [(1,)]
+
+    deleted.update(deleted_at="2030-01-02T00:00:00Z", updated_at="2030-01-02T00:00:00Z")
+    sync(conn, server)
+
+    assert rows(conn, "SELECT count(*) FROM transactions WHERE transaction_id = ?", transaction_id) == [(0,)]
+    assert rows(conn, "SELECT count(*) FROM transactions WHERE account = 'SPLITWISE'") == [(len(server.expenses) - 1,)]
+    assert sync_state.load_watermark(conn.cursor(), splitwise.SYNC_SOURCE) == {"updated_after": "2030-01-02T00:00:00Z"}
+
+
+def test_insert_into_db_writes_shares_and_transaction(conn):
+    expense = synthetic.splitwise_expenses(1)[0]
+    splitwise.SplitwiseRawTransaction.from_api(expense).insert_into_db(conn.cursor())
+    conn.commit()
+
+    assert rows(conn, "SELECT count(*) FROM splitwise_shares WHERE expense_id = ?", expense["id"]) == [(2,)]
+    assert rows(conn, "SELECT count(*) FROM transactions WHERE transaction_id = ? AND amount IS NOT NULL",
+                str(expense["id"])) == [(1,)]
+    assert rows(conn, "SELECT count(*) FROM transaction_merchants WHERE transaction_id = ?", str(expense["id"])) == [(1,)]
@@ -0,0 +1,37 @@
+import monzo
+import synthetic
+
+
+def load_monzo(conn, count: int):
+    monzo.store(conn, list(synthetic.monzo_records(count)))
+
+
+def test_transactions_rejects_malformed_month(conn, client):
+    load_monzo(conn, 20)
+    for month in ("2024-3x", "2024-13", "March"):
+        assert client.get("/transactions/", params={"month": month}).status_code == 422
+    assert client.get("/transactions/", params={"month": "2024-03"}).status_code == 200
+
+
+def test_page_reaches_every_timestamped_row(conn, client):
+    load_monzo(conn, 300)
+    conn.execute("UPDATE transactions SET timestamp = NULL WHERE rowid % 50 = 0")
+    conn.commit()
+    expected = conn.execute("SELECT count(*) FROM transactions WHERE timestamp IS NOT NULL").fetchone()[0]
+
+    seen, cursor = [], None
+    while True:
+        response = client.get("/transactions/page", params={"limit": 37, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        body = response.json()
+        seen += [t["transaction_id"] for t in body["transactions"]]
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+
+    assert len(seen) == len(set(seen)) == expected
+
+    # A page that would otherwise run on into the rows without a timestamp
+    response = client.get("/transactions/page", params={"limit": expected + 1})
+    assert response.status_code == 200
+    assert (len(response.json()["transactions"]), response.json()["next_cursor"]) == (expected, None)
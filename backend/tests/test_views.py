@@ -0,0 +1,43 @@
+import sqlite3
+
+import views
+from conftest import rows
+
+
+def test_main_skips_current_views(db_path):
+    assert views.main(True, db_path) is False
+    assert views.main(None, db_path) is False
+
+
+def test_main_rebuilds_missing_or_changed_definitions(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("DROP TRIGGER transactions_fts_insert")
+    assert views.main(None, db_path) is True
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE view_definitions SET digest = 'old'")
+    assert views.main(None, db_path) is True
+    assert views.main(None, db_path) is False
+
+
+def test_main_switches_mode(db_path):
+    assert views.main(False, db_path) is True
+    with sqlite3.connect(db_path) as conn:
+        assert not views.is_materialized(conn.cursor())
+        assert rows(conn, "SELECT type FROM sqlite_master WHERE name = 'monthly_rollup'") == [("view",)]
+    assert views.main(None, db_path) is False
+    assert views.main(True, db_path) is True
+
+
+def test_force_rebuilds(db_path):
+    assert views.main(None, db_path, force=True) is True
+
+
+def test_new_database_is_materialized(tmp_path):
+    path = str(tmp_path / "new.db")
+
+    assert views.main(None, path) is True
+
+    with sqlite3.connect(path) as conn:
+        assert views.is_materialized(conn.cursor())
+        assert rows(conn, "SELECT type FROM sqlite_master WHERE name IN ('monthly_rollup', 'transactions_fts') ORDER BY name") == [("table",), ("table",)]
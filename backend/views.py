@@ -1,11 +1,22 @@
+import argparse
+import hashlib
+import json
+import re
 import sqlite3
 from contextlib import closing
+from typing import Iterable, List, Optional
+
+import categories
+import db
+import merchants
+import sync_state
 
 AMEX_CLEANED_VIEW = """
 CREATE VIEW amex_transaction_cleaned AS
 SELECT 
     cast(reference as varchar) AS transaction_id,
-    strftime('%s', date(substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2))) AS timestamp,
+    timestamp,
+    month,
     description,
     -1 * amount as amount,
     address || ' ' || town_city || ' ' || postcode || ' ' || country as address,
@@ -17,11 +28,8 @@ MONZO_CLEANED_VIEW = """
 CREATE VIEW monzo_transaction_cleaned AS
 SELECT 
     cast(transaction_id as varchar) as transaction_id,
-    strftime('%s', 
-        date(substr(date, 7, 4) || '-' || 
-             substr(date, 4, 2) || '-' || 
-             substr(date, 1, 2) || ' ' || 
-             time)) AS timestamp,  -- Combine date and time into a Unix timestamp
+    timestamp,
+    month,
     name || ' ' || description || ' ' || notes_and_tags as description,
     amount,
     address as address,
@@ -29,26 +37,23 @@ SELECT
 FROM monzo_raw;
 """
 
+# Formatted with the owner's Splitwise user id; their share of each expense is a primary key lookup
 SPLITWISE_CLEANED_VIEW = """
 CREATE VIEW splitwise_transaction_cleaned AS
 SELECT
-    cast(id as varchar) AS transaction_id,
-    strftime('%s', date) AS timestamp,
-    description,
-    (
-        SELECT
-             cast(json_extract(value, '$.net_balance') as float)  -- Extract net_balance from the user
-        FROM
-            json_each(users)  -- Each user entry in the users JSON array
-        WHERE
-            json_extract(value, '$.user_id') = 51056312  -- Check for the specific user ID
-    ) AS amount,
+    cast(splitwise_raw.id as varchar) AS transaction_id,
+    splitwise_raw.timestamp,
+    splitwise_raw.month,
+    splitwise_raw.description,
+    owner_share.net_balance AS amount,
     NULL AS address,
-    ingestion_timestamp
+    splitwise_raw.ingestion_timestamp
 FROM
     splitwise_raw
+    LEFT JOIN splitwise_shares owner_share
+        ON owner_share.expense_id = splitwise_raw.id AND owner_share.user_id = {owner_user_id}
 WHERE
-    deleted_at is null;
+    splitwise_raw.deleted_at is null;
 """
 
 UNION_TRANSACTION_VIEW = """
@@ -65,6 +70,7 @@ CREATE VIEW transactions_with_category AS
 SELECT 
     transaction_id,
     timestamp,
+    month,
     description,
     amount,
     address,
@@ -81,35 +87,393 @@ LEFT JOIN categories USING (transaction_id)
 CATEGORIES_BY_MONTH = """
 CREATE VIEW monthly_category_spend AS
 SELECT 
-    strftime('%Y-%m', timestamp, 'unixepoch') AS month,
+    month,
     category,
     ROUND(SUM(amount), 2) AS total_spend
 FROM 
-    transactions_with_category
+    monthly_rollup
 GROUP BY 
     month, category
 ORDER BY 
     month DESC, category;
 """
 
+# Same shape as the materialized monthly_rollup table, derived on every read: a full GROUP BY over
+# every transaction per request. Only databases explicitly built with --no-materialize use it.
+MONTHLY_ROLLUP_VIEW = """
+CREATE VIEW monthly_rollup AS
+SELECT
+    month,
+    coalesce(category, 'UNKNOWN') AS category,
+    account,
+    sum(coalesce(amount, 0)) AS amount,
+    count(*) AS count
+FROM transactions_with_category
+WHERE month IS NOT NULL
+GROUP BY 1, 2, 3;
+"""
+
+
+TRANSACTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS transactions (
+    transaction_id TEXT PRIMARY KEY,
+    timestamp INTEGER,
+    month TEXT,
+    description TEXT,
+    amount REAL,
+    address TEXT,
+    account TEXT,
+    category TEXT,
+    ingestion_timestamp TIMESTAMP
+);
+"""
+
+TRANSACTIONS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_transactions_timestamp ON transactions (timestamp, transaction_id);",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_account ON transactions (account, timestamp, transaction_id);",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_category ON transactions (category, timestamp, transaction_id);",
+]
+
+# Keep transactions.category in step with every write to the categories table
+CATEGORY_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS categories_after_insert AFTER INSERT ON categories
+    BEGIN
+        UPDATE transactions
+        SET category = coalesce(NEW.user_category, NEW.model_category)
+        WHERE transaction_id = NEW.transaction_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS categories_after_update AFTER UPDATE ON categories
+    BEGIN
+        UPDATE transactions
+        SET category = coalesce(NEW.user_category, NEW.model_category)
+        WHERE transaction_id = NEW.transaction_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS categories_after_delete AFTER DELETE ON categories
+    BEGIN
+        UPDATE transactions SET category = NULL WHERE transaction_id = OLD.transaction_id;
+    END;
+    """,
+]
+
+POPULATE_TRANSACTIONS = """
+INSERT INTO transactions (transaction_id, timestamp, month, description, amount, address, account, category, ingestion_timestamp)
+SELECT
+    transaction_id,
+    timestamp,
+    month,
+    description,
+    amount,
+    address,
+    account,
+    coalesce(user_category, model_category),
+    ingestion_timestamp
+FROM all_transactions
+LEFT JOIN categories USING (transaction_id);
+"""
+
+TRANSACTIONS_WITH_CATEGORY_MATERIALIZED = """
+CREATE VIEW transactions_with_category AS
+SELECT 
+    transaction_id,
+    timestamp,
+    month,
+    description,
+    amount,
+    address,
+    account,
+    user_category,
+    model_category,
+    model_confidence,
+    category
+FROM transactions
+LEFT JOIN categories USING (transaction_id)
+"""
+
+MONTHLY_ROLLUP_TABLE = """
+CREATE TABLE IF NOT EXISTS monthly_rollup (
+    month TEXT,
+    category TEXT,
+    account TEXT,
+    amount REAL,
+    count INTEGER,
+    PRIMARY KEY (month, category, account)
+);
+"""
+
+# Serves /category_spend (category, then month range) and /categories/ without touching the table
+MONTHLY_ROLLUP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_monthly_rollup_category ON monthly_rollup (category, month);",
+]
+
+POPULATE_MONTHLY_ROLLUP = """
+INSERT INTO monthly_rollup (month, category, account, amount, count)
+SELECT
+    month,
+    coalesce(category, 'UNKNOWN'),
+    account,
+    sum(coalesce(amount, 0)),
+    count(*)
+FROM transactions
+WHERE month IS NOT NULL
+GROUP BY 1, 2, 3;
+"""
+
+# Adds/removes one transaction's contribution to its (month, category, account) cell.
+# Formatted with NEW or OLD; empty cells are deleted so the table only holds months with spend.
+_ROLLUP_ADD = """
+    INSERT INTO monthly_rollup (month, category, account, amount, count)
+    SELECT {row}.month, coalesce({row}.category, 'UNKNOWN'), {row}.account, coalesce({row}.amount, 0), 1
+    WHERE {row}.month IS NOT NULL
+    ON CONFLICT (month, category, account) DO UPDATE SET
+        amount = amount + excluded.amount,
+        count = count + 1;
+"""
+
+_ROLLUP_REMOVE = """
+    UPDATE monthly_rollup
+    SET amount = amount - coalesce({row}.amount, 0), count = count - 1
+    WHERE month = {row}.month
+        AND category = coalesce({row}.category, 'UNKNOWN')
+        AND account = {row}.account;
+    DELETE FROM monthly_rollup
+    WHERE month = {row}.month
+        AND category = coalesce({row}.category, 'UNKNOWN')
+        AND account = {row}.account
+        AND count <= 0;
+"""
+
+# Keep monthly_rollup in step with transactions. A recategorization arrives as an UPDATE of
+# transactions.category (see CATEGORY_TRIGGERS) and only moves the amount between two cells.
+ROLLUP_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS transactions_rollup_insert AFTER INSERT ON transactions
+    BEGIN
+        {_ROLLUP_ADD.format(row='NEW')}
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS transactions_rollup_delete AFTER DELETE ON transactions
+    BEGIN
+        {_ROLLUP_REMOVE.format(row='OLD')}
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS transactions_rollup_update AFTER UPDATE OF month, amount, category, account ON transactions
+    BEGIN
+        {_ROLLUP_REMOVE.format(row='OLD')}
+        {_ROLLUP_ADD.format(row='NEW')}
+    END;
+    """,
+]
+
+
+# Full-text index over the materialized transactions; external content, so only the index is stored
+TRANSACTIONS_FTS = """
+CREATE VIRTUAL TABLE IF NOT EXISTS transactions_fts USING fts5(
+    description,
+    address,
+    content='transactions',
+    content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+"""
+
+POPULATE_TRANSACTIONS_FTS = "INSERT INTO transactions_fts (transactions_fts) VALUES ('rebuild');"
+
+FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_insert AFTER INSERT ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (rowid, description, address) VALUES (NEW.rowid, NEW.description, NEW.address);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_delete AFTER DELETE ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, description, address)
+        VALUES ('delete', OLD.rowid, OLD.description, OLD.address);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS transactions_fts_update AFTER UPDATE OF description, address ON transactions
+    BEGIN
+        INSERT INTO transactions_fts (transactions_fts, rowid, description, address)
+        VALUES ('delete', OLD.rowid, OLD.description, OLD.address);
+        INSERT INTO transactions_fts (rowid, description, address) VALUES (NEW.rowid, NEW.description, NEW.address);
+    END;
+    """,
+]
+
+
+def drop_relation(cursor: sqlite3.Cursor, name: str):
+    """
+    Drops a table or view, whichever `name` currently is.
+    """
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = ? AND type IN ('table', 'view')", (name,))
+    row = cursor.fetchone()
+    if row:
+        cursor.execute(f"DROP {row[0].upper()} {name};")
+
+
+# account -> cleaned view its materialized rows are derived from
+MATERIALIZED_SOURCES = {
+    'AMEX': 'amex_transaction_cleaned',
+    'MONZO': 'monzo_transaction_cleaned',
+    'SPLITWISE': 'splitwise_transaction_cleaned',
+}
+
+
+def table_exists(cursor: sqlite3.Cursor, name: str) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def is_materialized(cursor: sqlite3.Cursor) -> bool:
+    return table_exists(cursor, 'transactions')
+
+
+def views_built(cursor: sqlite3.Cursor) -> bool:
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'all_transactions'")
+    return cursor.fetchone() is not None
+
+
+# Digest of the statements the views were last built from, so an unchanged build is skipped
+VIEW_DEFINITIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS view_definitions (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    digest TEXT NOT NULL
+);
+"""
+
+_CREATED = re.compile(r"CREATE\s+(?:VIRTUAL\s+)?(?:TABLE|VIEW|TRIGGER|INDEX)\s+(?:IF NOT EXISTS\s+)?(\w+)", re.IGNORECASE)
+
+
+def definitions(materialize: bool) -> List[str]:
+    """
+    The statements main() builds the views from, in order: with `materialize`, the transactions
+    table, rollup and search index, populated, and the triggers that keep them current.
+    """
+    import splitwise
+    statements = [
+        AMEX_CLEANED_VIEW,
+        MONZO_CLEANED_VIEW,
+        SPLITWISE_CLEANED_VIEW.format(owner_user_id=int(splitwise.OWNER_USER_ID)),
+        UNION_TRANSACTION_VIEW,
+    ]
+    if materialize:
+        statements += [TRANSACTIONS_TABLE, *TRANSACTIONS_INDEXES, POPULATE_TRANSACTIONS,
+                       MONTHLY_ROLLUP_TABLE, *MONTHLY_ROLLUP_INDEXES, POPULATE_MONTHLY_ROLLUP,
+                       TRANSACTIONS_FTS, POPULATE_TRANSACTIONS_FTS,
+                       *CATEGORY_TRIGGERS, *ROLLUP_TRIGGERS, *FTS_TRIGGERS,
+                       TRANSACTIONS_WITH_CATEGORY_MATERIALIZED]
+    else:
+        statements += [TRANSACTIONS_WITH_CATEGORY, MONTHLY_ROLLUP_VIEW]
+    statements.append(CATEGORIES_BY_MONTH)
+    return statements
+
+
+def definitions_digest(statements: Iterable[str]) -> str:
+    return hashlib.sha256("\n".join(statements).encode()).hexdigest()
+
+
+def views_current(cursor: sqlite3.Cursor, statements: List[str]) -> bool:
+    """
+    Whether the database was last built from exactly these statements and still has everything they create.
+    """
+    cursor.execute(VIEW_DEFINITIONS_TABLE)
+    cursor.execute("SELECT digest FROM view_definitions WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None or row[0] != definitions_digest(statements):
+        return False
+    names = {match.group(1) for statement in statements for match in _CREATED.finditer(statement)}
+    cursor.execute("SELECT count(*) FROM sqlite_master WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(sorted(names)),))
+    return cursor.fetchone()[0] == len(names)
+
+
+def refresh_transactions(cursor: sqlite3.Cursor, account: str, keys: Iterable):
+    """
+    Re-derive the materialized rows of one account for the given raw primary keys, typically the
+    changed_keys of an import. Does nothing when the transactions table has not been materialized.
+    """
+    keys = json.dumps([str(key) for key in keys])
+    if keys == '[]' or not is_materialized(cursor):
+        return
+    cursor.execute("""
+        DELETE FROM transactions
+        WHERE account = ? AND transaction_id IN (SELECT value FROM json_each(?))
+    """, (account, keys))
+    cursor.execute(f"""
+        INSERT INTO transactions (transaction_id, timestamp, month, description, amount, address, account, category, ingestion_timestamp)
+        SELECT
+            transaction_id,
+            timestamp,
+            month,
+            description,
+            amount,
+            address,
+            ?,
+            coalesce(user_category, model_category),
+            ingestion_timestamp
+        FROM {MATERIALIZED_SOURCES[account]}
+        LEFT JOIN categories USING (transaction_id)
+        WHERE transaction_id IN (SELECT value FROM json_each(?))
+    """, (account, keys))
 
 
-def main():
-    with sqlite3.connect('transactions.db') as db:
-        with closing(db.cursor()) as c:
+def main(materialize: Optional[bool] = None, path: str = db.LOCAL_DB_PATH, force: bool = False) -> bool:
+    """
+    Rebuilds the views when their definitions are missing or have changed, or when `force` is set.
+    `materialize` of None keeps whichever mode the database is already in, and materializes a
+    database whose views have never been built: the maintained transactions table, monthly rollup
+    and search index only exist in materialized mode. Loaders keep the
+    materialized tables current themselves, so an unchanged build is skipped rather than repopulated.
+    Returns whether the views were rebuilt.
+    """
+    with sqlite3.connect(path) as conn:
+        with closing(conn.cursor()) as c:
+            if materialize is None:
+                materialize = is_materialized(c) or not views_built(c)
+            # The cleaned views read the timestamp and month keys the loaders store; make sure every
+            # raw table exists and has them, backfilled, even for sources that have never been loaded
+            import amex, monzo, splitwise
+            amex.AmexRawTransaction.create_table(c)
+            monzo.MonzoRawTransaction.create_table(c)
+            splitwise.SplitwiseRawTransaction.create_table(c)
+            categories.create_table(c)
+            merchants.create_table(c)
+            statements = definitions(materialize)
+            if not force and views_current(c, statements):
+                return False
             c.execute("DROP VIEW IF EXISTS amex_transaction_cleaned;")
             c.execute("DROP VIEW IF EXISTS monzo_transaction_cleaned;")
             c.execute("DROP VIEW IF EXISTS splitwise_transaction_cleaned;")
             c.execute("DROP VIEW IF EXISTS all_transactions;")
             c.execute("DROP VIEW IF EXISTS transactions_with_category;")
             c.execute("DROP VIEW IF EXISTS monthly_category_spend;")
-            c.execute(AMEX_CLEANED_VIEW)
-            c.execute(MONZO_CLEANED_VIEW)
-            c.execute(SPLITWISE_CLEANED_VIEW)
-            c.execute(UNION_TRANSACTION_VIEW)
-            c.execute(TRANSACTIONS_WITH_CATEGORY)
-            c.execute(CATEGORIES_BY_MONTH)
+            c.execute("DROP TRIGGER IF EXISTS categories_after_insert;")
+            c.execute("DROP TRIGGER IF EXISTS categories_after_update;")
+            c.execute("DROP TRIGGER IF EXISTS categories_after_delete;")
+            drop_relation(c, "monthly_rollup")
+            c.execute("DROP TABLE IF EXISTS transactions_fts;")
+            c.execute("DROP TABLE IF EXISTS transactions;")
+            for statement in statements:
+                c.execute(statement)
+            c.execute("INSERT OR REPLACE INTO view_definitions (id, digest) VALUES (1, ?)", (definitions_digest(statements),))
+            sync_state.bump_data_version(c)
+            return True
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Rebuild the transaction views.")
+    parser.add_argument('--materialize', action=argparse.BooleanOptionalAction, default=None,
+                        help="Write a real, indexed transactions table instead of deriving it on every read. "
+                             "Defaults to the database's current mode, or materialized for a new database.")
+    parser.add_argument('--force', action='store_true', help="Rebuild even if the views are already current.")
+    args = parser.parse_args()
+    print("Views rebuilt" if main(args.materialize, force=args.force) else "Views already current")
@@ -26,11 +26,8 @@ function Trends() {
     };
 
   useEffect(() => {
-    axios.get('http://localhost:8000/transactions/')
-      .then(res => {
-        const cats = Array.from(new Set(res.data.map(t => t.category || 'UNKNOWN')));
-        setCategories(cats.sort());
-      })
+    axios.get('http://localhost:8000/categories/')
+      .then(res => setCategories(res.data))
       .catch(console.error);
   }, []);
 
@@ -80,18 +77,19 @@ function Trends() {
       const monthNames = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec'];
       const fetchedGroupCharts = {};
 
+      const params = new URLSearchParams();
+      Object.values(categoryGroups).flat().forEach(cat => params.append('category', cat));
+      let spendByCategory = {};
+      try {
+        const response = await axios.get(`http://localhost:8000/category_spend/batch?${params}`);
+        spendByCategory = response.data;
+      } catch (error) {
+        console.error('Error fetching category spend:', error);
+      }
+
       for (let group in categoryGroups) {
         const subcategories = categoryGroups[group];
-        const allData = [];
-
-        for (let cat of subcategories) {
-          try {
-            const response = await axios.get(`http://localhost:8000/category_spend?category=${encodeURIComponent(cat)}`);
-            allData.push(...response.data);
-          } catch (error) {
-            console.error(`Error fetching ${cat}:`, error);
-          }
-        }
+        const allData = subcategories.flatMap(cat => spendByCategory[cat] || []);
 
         const yrs = Array.from(new Set(allData.map(d => d.year))).sort();
         const accum = {};